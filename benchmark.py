@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Benchmark convert-comic.py configurations on the same input.
+# Every configuration runs as a separate convert-comic.py process, so
+# wall time and peak memory include startup and all of its workers.
+
+import os
+import sys
+import time
+import shutil
+import filecmp
+import tempfile
+import threading
+import subprocess
+import numpy as np
+from PIL import Image
+
+CONVERT_COMIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'convert-comic.py')
+
+# Name and extra convert-comic.py options of each configuration. The
+# output of the first one is the reference for the others.
+CONFIGURATIONS = [
+    ('exact', ['--exact-resize']),
+    ('processes', []),
+    ('threads', ['--threads']),
+    ('16-bit', ['--precision=16']),
+    ('8-bit', ['--precision=8']),
+]
+
+# Interval of memory samples, in seconds
+SAMPLE_INTERVAL = 0.05
+
+
+# Resident memory of a process and its children, in bytes (Linux only)
+def tree_rss(pid):
+    total = 0
+    pending = [pid]
+    while len(pending) > 0:
+        p = pending.pop()
+        try:
+            with open('/proc/{}/status'.format(p)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+            for task in os.listdir('/proc/{}/task'.format(p)):
+                with open('/proc/{}/task/{}/children'.format(p, task)) as f:
+                    pending.extend(int(x) for x in f.read().split())
+        except (OSError, ValueError):
+            pass
+    return total
+
+
+# Run convert-comic.py, return wall time and peak memory (None if unknown)
+def run(options, width, height, input_path, output_path):
+    args = [sys.executable, CONVERT_COMIC] + options + [str(width), str(height), input_path, output_path]
+    peak = [None]
+
+    start = time.perf_counter()
+    process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def sample():
+        while process.poll() is None:
+            if os.path.exists('/proc/{}/status'.format(process.pid)):
+                peak[0] = max(peak[0] or 0, tree_rss(process.pid))
+            time.sleep(SAMPLE_INTERVAL)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    _, stderr = process.communicate()
+    elapsed = time.perf_counter() - start
+    sampler.join()
+
+    if process.returncode != 0:
+        raise RuntimeError('convert-comic.py {} failed:\n{}'.format(' '.join(options), stderr.decode(errors='replace')))
+    return elapsed, peak[0]
+
+
+# Peak signal-to-noise ratio of two images, in dB
+def psnr(file0, file1):
+    with Image.open(file0) as img0, Image.open(file1) as img1:
+        if img0.size != img1.size:
+            return 0
+        a = np.asarray(img0.convert('L'), dtype=np.float64)
+        b = np.asarray(img1.convert('L'), dtype=np.float64)
+    mse = np.mean(np.square(a - b))
+    return float('inf') if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+# Compare the output of a configuration with the reference
+# Return: 'identical', or the lowest PSNR of all pages
+def compare_output(dir0, dir1):
+    files0 = sorted(os.listdir(dir0))
+    if files0 != sorted(os.listdir(dir1)):
+        return 'different pages'
+    pairs = [(os.path.join(dir0, x), os.path.join(dir1, x)) for x in files0]
+    if all(filecmp.cmp(x, y, shallow=False) for x, y in pairs):
+        return 'identical'
+    return 'PSNR >= {:.1f} dB'.format(min(psnr(x, y) for x, y in pairs))
+
+
+def format_size(n):
+    return '{:.0f} MiB'.format(n / (1024 * 1024)) if n is not None else '-'
+
+
+def usage():
+    print('Usage: python benchmark.py [--repeat=<n>] <width> <height> <input>')
+    print()
+    print('Runs convert-comic.py with each configuration on <input> (directory, zip, cbz')
+    print('or azw3) and prints the best wall time and peak memory of each, and how its')
+    print('output compares to the first configuration (lowest PSNR over all pages).')
+
+
+def main(argv):
+    repeat = 3
+    args = []
+    for x in argv[1:]:
+        if x.startswith('--repeat='):
+            repeat = int(x[len('--repeat='):])
+        else:
+            args.append(x)
+
+    if len(args) != 3:
+        usage()
+        return
+
+    width, height, input_path = int(args[0]), int(args[1]), args[2]
+
+    print('benchmark.py: {} at {}x{}, best of {}'.format(input_path, width, height, repeat))
+    print()
+    print('{:<12} {:>10} {:>12}  {}'.format('config', 'time', 'peak memory', 'output vs reference'))
+
+    tmpdir = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        reference = None
+        for name, options in CONFIGURATIONS:
+            output_path = os.path.join(tmpdir, name)
+            results = []
+            for _ in range(repeat):
+                shutil.rmtree(output_path, ignore_errors=True)
+                results.append(run(options, width, height, input_path, output_path))
+
+            elapsed = min(x[0] for x in results)
+            peaks = [x[1] for x in results if x[1] is not None]
+            peak = max(peaks) if len(peaks) > 0 else None
+
+            if reference is None:
+                reference = output_path
+                check = 'reference'
+            else:
+                check = compare_output(reference, output_path)
+            print('{:<12} {:>9.2f}s {:>12}  {}'.format(name, elapsed, format_size(peak), check), flush=True)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,12 +1,24 @@
 #!/usr/bin/env python3
 
-from PIL import Image
+from PIL import Image, ImageFilter
 import os
 import io
+import re
+import math
+import time
+import queue
+import shutil
+import tempfile
+import threading
+import collections
+import zipfile
+from multiprocessing import shared_memory
 import numpy as np
 import mozjpeg_lossless_optimization
 
 from kf8comic import read_azw3
+from kindleunpack.imageprobe import probe_image, probe_stream
+from merge_spread import image_edges, calculate_edges_contrast, merge_image
 
 GAMMA = 1.8
 PALETTE = [
@@ -33,9 +45,46 @@ PAL_IMG.putpalette(PALETTE)
 
 ALL = 0
 
+# Pages with more pixels than this are processed in bands of rows, so
+# no full size floating point copy of the page is made
+TILED_PIXELS = 32 * 1024 * 1024
+
+# Pixels in a band of rows of the tiled path
+TILE_PIXELS = 4 * 1024 * 1024
+
+# Support of the LANCZOS filter, in pixels at scale 1
+LANCZOS_SUPPORT = 3
+
+# Large downscales first reduce the page by an integer factor (box filter),
+# keeping at least this much scale for the LANCZOS pass. None resizes with
+# LANCZOS only (--exact-resize).
+REDUCING_GAP = 2.0
+
+# Precision of pages between conversion and gamma: 'float' (32-bit float
+# 'F'), '16' (16-bit integer 'I;16') or '8' ('L')
+PRECISION = 'float'
+WORKING_MODES = {'float': 'F', '16': 'I;16', '8': 'L'}
+
+# Settings copied to worker processes, as they may not be forked from main
+WORKER_SETTINGS = ('REDUCING_GAP', 'PRECISION', 'PASSTHROUGH')
+
+
+def worker_settings():
+    return {x: globals()[x] for x in WORKER_SETTINGS}
+
+
+def init_worker(settings):
+    globals().update(settings)
+    # Handles forked from the parent share its file offsets
+    ZIP_FILES.clear()
+
 
 def calculate_image_size(image, d_width, d_height):
-    width, height = image.size
+    return calculate_size(image.size, d_width, d_height)
+
+
+def calculate_size(size, d_width, d_height):
+    width, height = size
     ratio = min(d_width / width, d_height / height)
     new_width = int(width * ratio)
     new_height = int(height * ratio)
@@ -57,52 +106,288 @@ def contrast_gamma(image):
     return image
 
 
-def detect_bounding_box(bound_image, a, b):
+# Gamma of every 'L' or 'I;16' value, scaled to 0-65535
+GAMMA_LUTS = {}
+
+
+def gamma_lut(maxval):
+    if maxval not in GAMMA_LUTS:
+        GAMMA_LUTS[maxval] = np.round(np.power(np.arange(maxval + 1) / maxval, GAMMA) * 65535).astype(np.uint32)
+    return GAMMA_LUTS[maxval]
+
+
+# Same as contrast_gamma for 'L' and 'I;16' images, with a lookup table and
+# integer arithmetic. Returns an 'L' image.
+def contrast_gamma_int(image):
+    data = gamma_lut(65535 if image.mode == 'I;16' else 255)[np.asarray(image)]
+    min_, max_ = int(np.amin(data)), int(np.amax(data))
+    if min_ == max_:
+        min_, max_ = 0, 65535
+    data = ((data - min_) * 510 + (max_ - min_)) // (2 * (max_ - min_))
+    return Image.fromarray(data.astype(np.uint8))
+
+
+# Convert a page to the PRECISION working mode. bound is image.convert('L').
+def to_working(image, bound):
+    if PRECISION == '8':
+        return bound
+    if PRECISION == '16':
+        return Image.fromarray(np.asarray(bound, dtype=np.uint16) * 257)
+    return image.convert('F', dither=Image.FLOYDSTEINBERG)
+
+
+# LANCZOS resize of a working image. Pillow cannot reduce 'I;16' images.
+def resize_working(img, size, box):
+    reducing_gap = REDUCING_GAP if img.mode != 'I;16' else None
+    return img.resize(size, Image.LANCZOS, box=box, reducing_gap=reducing_gap)
+
+
+def detect_bounding_box(bound_image, a, b, max_margin=None):
     bound_image = bound_image.point(lambda x: 0 if x >= a and x <= b else 255)
-    bbox = bound_image.getbbox()
+    return limit_bounding_box(bound_image.getbbox(), bound_image.size, max_margin)
+
+
+# Limit the empty border cropped by a content bounding box to max_margin
+# (10% of the size by default)
+def limit_bounding_box(bbox, size, max_margin=None):
     if bbox is not None:
         min_margin = [0, 0]
-        max_margin = [int(0.1 * i + 0.5) for i in bound_image.size]
+        if max_margin is None:
+            max_margin = [int(0.1 * i + 0.5) for i in size]
         bbox = (
             max(0, min(max_margin[0], bbox[0] - min_margin[0])),
             max(0, min(max_margin[1], bbox[1] - min_margin[1])),
-            min(bound_image.size[0],
-                max(bound_image.size[0] - max_margin[0], bbox[2] + min_margin[0])),
-            min(bound_image.size[1],
-                max(bound_image.size[1] - max_margin[1], bbox[3] + min_margin[1])),
+            min(size[0],
+                max(size[0] - max_margin[0], bbox[2] + min_margin[0])),
+            min(size[1],
+                max(size[1] - max_margin[1], bbox[3] + min_margin[1])),
         )
         return bbox
     else:
         return None
 
 
-def crop_empty_border(image, bound_img):
-    bbox1 = detect_bounding_box(bound_img, 0, 16)
-    bbox2 = detect_bounding_box(bound_img, 235, 255)
+# Crop box of both black and white border
+def combine_bounding_boxes(bbox1, bbox2):
     if bbox1 is None and bbox2 is None:
-        return image
+        return None
     elif bbox1 is None:
-        return image.crop(bbox2)
+        return bbox2
     elif bbox2 is None:
-        return image.crop(bbox1)
+        return bbox1
     else:
-        return image.crop([max(bbox1[0], bbox2[0]), max(bbox1[1], bbox2[1]), min(bbox1[2], bbox2[2]), min(bbox1[3], bbox2[3])])
+        return [max(bbox1[0], bbox2[0]), max(bbox1[1], bbox2[1]), min(bbox1[2], bbox2[2]), min(bbox1[3], bbox2[3])]
 
 
-# Process individual image (must be after a double-spread is splitted)
-def process_image_inner(image, d_width, d_height):
-    # First, convert to floating point (greyscale)
-    img = image.convert('F', dither=Image.FLOYDSTEINBERG)
+def detect_empty_border(bound_img, max_margin=None):
+    bbox1 = detect_bounding_box(bound_img, 0, 16, max_margin)
+    bbox2 = detect_bounding_box(bound_img, 235, 255, max_margin)
+    return combine_bounding_boxes(bbox1, bbox2)
+
+
+def crop_empty_border(image, bound_img):
+    bbox = detect_empty_border(bound_img)
+    if bbox is None:
+        return image
+    return image.crop(bbox)
+
+
+# Source image of a tiled page, in a mode Pillow can hand out as rows
+def tiled_source(image):
+    if image.mode not in ('L', 'RGB'):
+        return image.convert('RGB')
+    return image
+
+
+# Rows of the image in each band of the tiled path
+def tile_rows(width):
+    return max(1, TILE_PIXELS // max(1, width))
+
+
+# Same as detect_empty_border on image.convert('L'), but built from row and
+# column profiles gathered one band of rows at a time
+def detect_empty_border_tiled(image, max_margin=None):
+    width, height = image.size
+    profiles = [((0, 16), np.zeros(width, bool), np.zeros(height, bool)),
+                ((235, 255), np.zeros(width, bool), np.zeros(height, bool))]
+    rows = tile_rows(width)
+    for y in range(0, height, rows):
+        band = np.asarray(image.crop((0, y, width, min(height, y + rows))).convert('L'))
+        for (a, b), columns, lines in profiles:
+            content = (band < a) | (band > b)
+            columns |= content.any(axis=0)
+            lines[y:y + band.shape[0]] = content.any(axis=1)
+
+    bboxes = []
+    for _, columns, lines in profiles:
+        if not columns.any():
+            bboxes.append(None)
+            continue
+        xs, ys = np.flatnonzero(columns), np.flatnonzero(lines)
+        bbox = (int(xs[0]), int(ys[0]), int(xs[-1]) + 1, int(ys[-1]) + 1)
+        bboxes.append(limit_bounding_box(bbox, image.size, max_margin))
+    return combine_bounding_boxes(*bboxes)
+
+
+# Resize box of a large image to size, converting to the working mode one
+# band at a time. Each band is read with the rows and columns the filter
+# reaches around it, so it matches a resize of the whole image.
+def resize_tiled(image, box, size):
+    x0, y0, x1, y1 = box
+    scale_x = (x1 - x0) / size[0]
+    scale_y = (y1 - y0) / size[1]
+    margin_x = LANCZOS_SUPPORT * max(scale_x, 1) + 1
+    margin_y = LANCZOS_SUPPORT * max(scale_y, 1) + 1
+    tx0 = max(0, int(x0 - margin_x))
+    tx1 = min(image.width, int(x1 + margin_x) + 1)
+
+    result = Image.new(WORKING_MODES[PRECISION], size)
+    out_rows = max(1, int(tile_rows(tx1 - tx0) / max(scale_y, 1)))
+    for oy0 in range(0, size[1], out_rows):
+        oy1 = min(size[1], oy0 + out_rows)
+        sy0 = y0 + oy0 * scale_y
+        sy1 = y0 + oy1 * scale_y
+        ty0 = max(0, int(sy0 - margin_y))
+        ty1 = min(image.height, int(sy1 + margin_y) + 1)
+
+        band = image.crop((tx0, ty0, tx1, ty1))
+        band = to_working(band, band.convert('L'))
+        band = resize_working(band, (size[0], oy1 - oy0), (x0 - tx0, sy0 - ty0, x1 - tx0, sy1 - ty0))
+        result.paste(band, (0, oy0))
+    return result
+
+
+# A page is uniform (blank) if all but UNIFORM_OUTLIERS of its pixels, and
+# at most UNIFORM_MAX_OUTLIERS pixels, are within UNIFORM_RANGE levels,
+# and no two of the other pixels touch: those are specks of dust, while
+# even a small page number or signature has touching pixels
+UNIFORM_RANGE = 8
+UNIFORM_OUTLIERS = 0.0001
+UNIFORM_MAX_OUTLIERS = 32
+
+
+# Level (0-255) of a near-uniform 'L' image, or None
+def uniform_level(bound):
+    histogram = np.array(bound.histogram())
+    outliers = min(UNIFORM_OUTLIERS * bound.width * bound.height, UNIFORM_MAX_OUTLIERS)
+    cumulative = np.cumsum(histogram)
+    low = int(np.searchsorted(cumulative, outliers, side='right'))
+    high = int(np.searchsorted(cumulative, cumulative[-1] - outliers, side='left'))
+    if high - low > UNIFORM_RANGE:
+        return None
+
+    # Pixels outside low..high
+    outside = (cumulative[low - 1] if low > 0 else 0) + cumulative[-1] - cumulative[high]
+    if outside > 0:
+        data = np.asarray(bound)
+        ys, xs = np.nonzero((data < low) | (data > high))
+        for k in range(len(xs)):
+            if np.any((np.abs(xs[k + 1:] - xs[k]) <= 1) & (np.abs(ys[k + 1:] - ys[k]) <= 1)):
+                return None
+    return int(round(np.dot(histogram, np.arange(256)) / cumulative[-1]))
+
+
+# A uniform page is a 1x1 image of its level, with the box of the page
+def uniform_page(level, box):
+    return Image.new('L', (1, 1), level), box, 'uniform'
+
+
+# Rendered uniform pages, by (size, level)
+UNIFORM_IMAGES = {}
+
+
+# Rendered uniform page, the same as rendering a page of that level
+def uniform_image(size, level):
+    key = (size, level)
+    if key not in UNIFORM_IMAGES:
+        image = finish_image(Image.new('F', size, level))
+        image.info['uniform'] = key
+        UNIFORM_IMAGES[key] = image
+    return UNIFORM_IMAGES[key]
+
+
+# Convert and crop a single page (must be after a double-spread is splitted)
+# Return: page as (working image, box to resize from, kind). Pages above
+# TILED_PIXELS are 'tiled': not converted, and blank pages 'uniform': not
+# converted nor cropped, see render_page. Other pages have kind None.
+def crop_page(image):
+    if image.width * image.height > TILED_PIXELS:
+        image = tiled_source(image)
+        bbox = detect_empty_border_tiled(image)
+        return image, tuple(bbox) if bbox is not None else (0, 0) + image.size, 'tiled'
+
+    bound = image.convert('L')
+    level = uniform_level(bound)
+    if level is not None:
+        return uniform_page(level, (0, 0) + image.size)
+
+    # First, convert to floating point (greyscale), or the PRECISION mode
+    img = to_working(image, bound)
 
     # Then, crop
-    img = crop_empty_border(img, image.convert('L'))
+    img = crop_empty_border(img, bound)
+    return img, (0, 0) + img.size, None
 
-    # Then, resize
-    new_width, new_height = calculate_image_size(img, d_width, d_height)
-    img = img.resize((new_width, new_height), Image.LANCZOS)
 
-    # Then, apply gamma
-    img = contrast_gamma(img)
+# Convert and crop a double-page spread, returning [right page, left page].
+# The spread is converted and checked for empty border once. Only the
+# outer border is cropped, as the seam is not a border, and both pages
+# share the spread buffer, each with its own box.
+def crop_spread(image):
+    # Margins are limited per page, as for a single page
+    max_margin = [int(0.05 * image.width + 0.5), int(0.1 * image.height + 0.5)]
+    left = image.width // 2
+    kind = None
+    if image.width * image.height > TILED_PIXELS:
+        kind = 'tiled'
+        img = tiled_source(image)
+        bbox = detect_empty_border_tiled(img, max_margin)
+    else:
+        bound = image.convert('L')
+        level = uniform_level(bound)
+        if level is not None:
+            return [uniform_page(level, (left, 0, image.width, image.height)), uniform_page(level, (0, 0, left, image.height))]
+        img = to_working(image, bound)
+        bbox = detect_empty_border(bound, max_margin)
+    if bbox is None:
+        bbox = [0, 0, image.width, image.height]
+
+    return [(img, (left, bbox[1], bbox[2], bbox[3]), kind), (img, (bbox[0], bbox[1], left, bbox[3]), kind)]
+
+
+# Size can be given from a header probe, so orientation is known before
+# Pillow touches the image
+def crop_pages(image, size=None):
+    width, height = size if size is not None else image.size
+    if width < height:
+        return [crop_page(image)]
+
+    # Split into two
+    return crop_spread(image)
+
+
+# Resize a cropped page to fit the device, then apply gamma and quantize.
+# A page can be rendered for any number of device sizes.
+def render_page(page, d_width, d_height):
+    img, box, kind = page
+    size = calculate_size((box[2] - box[0], box[3] - box[1]), d_width, d_height)
+    if kind == 'uniform':
+        return uniform_image(size, img.getpixel((0, 0)))
+    if kind == 'tiled':
+        # Still in its source mode
+        img = resize_tiled(img, box, size)
+    else:
+        img = resize_working(img, size, box)
+    return finish_image(img)
+
+
+# Gamma and quantization of a resized working image
+def finish_image(img):
+    # Apply gamma
+    if img.mode == 'F':
+        img = contrast_gamma(img)
+    else:
+        img = contrast_gamma_int(img)
 
     # Then, quantize
     img = img.convert('L')
@@ -113,78 +398,671 @@ def process_image_inner(image, d_width, d_height):
     return img
 
 
-def process_image(image, d_width, d_height):
-    if image.width < image.height:
-        return [process_image_inner(image, d_width, d_height)]
+# Process individual image (must be after a double-spread is splitted)
+def process_image_inner(image, d_width, d_height):
+    return render_page(crop_page(image), d_width, d_height)
 
-    # Split into two
-    left = image.width // 2
-    return [process_image_inner(x, d_width, d_height) for x in
-            [image.crop((left, 0, image.width, image.height)), image.crop((0, 0, left, image.height))]]
 
+def process_image(image, d_width, d_height, size=None):
+    return [render_page(x, d_width, d_height) for x in crop_pages(image, size)]
 
+
+# Encoded uniform pages, by (size, level)
+UNIFORM_JPEGS = {}
+
+
+# Save as JPEG into output_dir and return the file name.
+# If output_dir is None, return (name, JPEG bytes) for the archive writer.
 def save_image_mozjpeg(image, output_dir, i, extra=''):
-    filename = os.path.join(output_dir, '{:05d}{}.jpg'.format(i + 1, extra))
-    with io.BytesIO() as output:
-        image.save(output, format="JPEG", optimize=1, quality=85)
-        input_jpeg_bytes = output.getvalue()
-        output_jpeg_bytes = mozjpeg_lossless_optimization.optimize(input_jpeg_bytes)
-        with open(filename, "wb") as output_jpeg_file:
-            output_jpeg_file.write(output_jpeg_bytes)
+    name = '{:05d}{}.jpg'.format(i + 1, extra)
+    uniform = image.info.get('uniform')
+    if uniform is not None and uniform in UNIFORM_JPEGS:
+        output_jpeg_bytes = UNIFORM_JPEGS[uniform]
+    else:
+        with io.BytesIO() as output:
+            image.save(output, format="JPEG", optimize=1, quality=85)
+            input_jpeg_bytes = output.getvalue()
+            output_jpeg_bytes = mozjpeg_lossless_optimization.optimize(input_jpeg_bytes)
+        if uniform is not None:
+            UNIFORM_JPEGS[uniform] = output_jpeg_bytes
+
+    return store_jpeg(output_jpeg_bytes, output_dir, name)
+
+
+# Write JPEG bytes into output_dir, see save_image_mozjpeg
+def store_jpeg(data, output_dir, name):
+    if output_dir is None:
+        return name, data
+
+    filename = os.path.join(output_dir, name)
+    with open(filename, "wb") as output_jpeg_file:
+        output_jpeg_file.write(data)
+    return filename
+
+
+# Pages already converted for the device are copied as-is ('copy'), or
+# with only the lossless mozjpeg pass ('optimize'). None converts all pages.
+PASSTHROUGH = None
+
+# A conformant page has at least this many sampled pixels on the palette
+# levels as half way between two levels
+PALETTE_PEAK_RATIO = 1.75
 
+# Sample every PALETTE_SAMPLE_STEP pixel of every PALETTE_SAMPLE_STEP row
+PALETTE_SAMPLE_STEP = 2
+
+
+# Header check: a grey or RGB JPEG already the size the page would be
+# resized to for the target, without split
+def conformant_size(info, d_width, d_height):
+    if info is None or info[0] != 'jpeg' or info[3] not in ('L', 'RGB'):
+        return False
+    _, width, height, _ = info
+    return width < height and width <= d_width and height <= d_height and (width == d_width or height == d_height)
+
+
+# Sampled palette test. JPEG blurs the dithering of a quantized page, but
+# its histogram keeps peaks at the palette levels. The page is decoded in
+# full: a reduced (draft) decode averages the dithering and loses the peaks.
+# Only the sampled pixels are converted.
+def is_palette_image(image):
+    data = np.asarray(image)[::PALETTE_SAMPLE_STEP, ::PALETTE_SAMPLE_STEP]
+    if image.mode == 'L':
+        grey = data
+    else:
+        rgb = data.astype(np.int32)
+        if np.amax(np.abs(rgb[..., 0] - rgb[..., 1])) > 8 or np.amax(np.abs(rgb[..., 1] - rgb[..., 2])) > 8:
+            return False
+        # Same as Pillow's conversion to 'L'
+        grey = (rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16
+    histogram = np.bincount(grey.ravel(), minlength=256)
+    levels = range(17, 255, 17)
+    on = sum(histogram[x - 1:x + 2].sum() for x in levels)
+    off = sum(histogram[x + 7:x + 10].sum() for x in levels[:-1])
+    # Mostly black and white pages have few pixels to tell
+    return on >= PALETTE_PEAK_RATIO * off
+
+
+# Targets the page can be passed through to
+def passthrough_targets(info, image, targets):
+    if PASSTHROUGH is None:
+        return [False for _ in targets]
+    sized = [conformant_size(info, d_width, d_height) for _, d_width, d_height in targets]
+    if not any(sized) or not is_palette_image(image):
+        return [False for _ in targets]
+    return sized
+
+
+# Output of a page passed through, source is the file name or its content
+def save_passthrough(source, output_dir, i):
+    if isinstance(source, bytes):
+        data = source
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+    if PASSTHROUGH == 'optimize':
+        data = mozjpeg_lossless_optimization.optimize(data)
+    return store_jpeg(data, output_dir, '{:05d}.jpg'.format(i + 1))
+
+
+# ZIP archives opened by this worker, by path
+ZIP_FILES = {}
+ZIP_FILES_LOCK = threading.Lock()
+
+
+# Read a member of a ZIP archive. Each worker keeps its own handle on the
+# archive, so members are inflated in the workers, in parallel.
+def read_zip_member(archive, name):
+    with ZIP_FILES_LOCK:
+        if archive not in ZIP_FILES:
+            ZIP_FILES[archive] = zipfile.ZipFile(archive, 'r')
+    try:
+        return ZIP_FILES[archive].read(name)
+    except:
+        print('Error: cannot open image ' + name)
+        raise
+
+
+# Image source is either a file path, the image file content, or a member
+# of a ZIP archive as (archive path, member name)
+def read_source(source):
+    if isinstance(source, tuple):
+        return read_zip_member(*source)
+    return source
+
+
+# The parent probes ZIP members for the scheduler (task_memory). It only
+# inflates the start of a member, up to the JPEG SOF or PNG IHDR header:
+# PROBE_ZIP_SIZE bytes, doubled while the header is not complete, up to
+# PROBE_ZIP_MAX_SIZE. Image data is still only read by the workers.
+PROBE_ZIP_SIZE = 4 * 1024
+PROBE_ZIP_MAX_SIZE = 64 * 1024
+
+# Archive probed by the parent, kept open for the pages of one book only.
+# Not in ZIP_FILES, as workers forked from the parent would share it.
+PROBE_ZIP_FILE = [None]
+PROBE_ZIP_LOCK = threading.Lock()
+
+
+def probe_zip_file(archive):
+    if PROBE_ZIP_FILE[0] is None or PROBE_ZIP_FILE[0].filename != archive:
+        if PROBE_ZIP_FILE[0] is not None:
+            PROBE_ZIP_FILE[0].close()
+        PROBE_ZIP_FILE[0] = zipfile.ZipFile(archive, 'r')
+    return PROBE_ZIP_FILE[0]
+
+
+# Header of a page source, without reading or inflating all of it
+# Return: (type, width, height, mode), or None
+def probe_source(source):
+    try:
+        if isinstance(source, tuple):
+            archive, name = source
+            with PROBE_ZIP_LOCK:
+                zip_ref = probe_zip_file(archive)
+                with zip_ref.open(name) as f:
+                    return probe_stream(f, PROBE_ZIP_SIZE, PROBE_ZIP_MAX_SIZE)
+        return probe_image(source)
+    except (OSError, KeyError, zipfile.BadZipFile):
+        # The worker reports it
+        return None
+
+
+def open_image(source):
+    if isinstance(source, bytes):
+        return Image.open(io.BytesIO(source))
+    return Image.open(source)
+
+
+# Process a page. The page is decoded and cropped once, then rendered
+# for every target (output_dir, d_width, d_height), unless it can be passed
+# through. With the spread merging stage (direction is not None), the seam
+# edges of portrait pages are returned from the same decode.
+# Return: page index, edges, output files of each target
+def process_and_save_image(source, i, targets, direction=None):
+    source = read_source(source)
+
+    # Read header only, then open (decoding happens on first use)
+    info = probe_image(source)
+    image = open_image(source)
 
-def process_and_save_image(image, i, output_dir, d_width, d_height):
     # Process image
-    images = process_image(image, d_width, d_height)
-    if len(images) == 1:
-        save_image_mozjpeg(images[0], output_dir, i)
+    passthrough = passthrough_targets(info, image, targets)
+    pages = None
+    outputs = []
+    for (output_dir, d_width, d_height), conformant in zip(targets, passthrough):
+        if conformant:
+            outputs.append([save_passthrough(source, output_dir, i)])
+            continue
+        if pages is None:
+            pages = crop_pages(image, size=info[1:3] if info is not None else None)
+        images = [render_page(x, d_width, d_height) for x in pages]
+        if len(images) == 1:
+            outputs.append([save_image_mozjpeg(images[0], output_dir, i)])
+        else:
+            outputs.append([save_image_mozjpeg(x, output_dir, i, extra='-{}'.format(idx)) for idx, x in enumerate(images)])
+
+    edges = None
+    if direction is not None and image.width < image.height:
+        edges = image_edges(image)
+    return i, edges, outputs
+
+
+# Process pages i and i+1 merged as a single double-page spread
+def process_and_save_spread(sources, i, targets, direction):
+    spread = merge_image(open_image(read_source(sources[0])), open_image(read_source(sources[1])), direction)
+    page = crop_page(spread)
+    outputs = []
+    for output_dir, d_width, d_height in targets:
+        image = render_page(page, d_width * 2, d_height)
+        outputs.append([save_image_mozjpeg(image, output_dir, i, extra='-{:05d}'.format(i + 2))])
+    return i, None, outputs
+
+
+# Task: (sources, page index, targets, direction)
+# A task with two sources is a double-page spread from the merging stage.
+def process_task(task):
+    sources, i, targets, direction = task
+    if len(sources) == 2:
+        return process_and_save_spread(sources, i, targets, direction)
+    return process_and_save_image(sources[0], i, targets, direction)
+
+
+# Used in batch mode, with the index of the book of the task
+def process_book_task(args):
+    book_index, task = args
+    return book_index, process_task(task)
+
+
+# Staged pipeline: decode, transform and encode run in separate pools.
+# Page buffers are passed between stages in shared memory, as
+# (block name, shape, dtype), instead of being pickled.
+
+# Copy an array into a new shared memory block
+def share_array(arr):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)[...] = arr
+    shm.close()
+    return shm.name, arr.shape, arr.dtype.str
+
+
+# Free a shared memory block without reading it
+def free_array(ref):
+    shm = shared_memory.SharedMemory(name=ref[0])
+    shm.close()
+    shm.unlink()
+
+
+# Copy an array out of shared memory and free the block
+def take_array(ref):
+    name, shape, dtype = ref
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+# Size of the difference hash of a page, 16 gives a 256-bit hash
+HASH_SIZE = 16
+
+# Pages are duplicates if their hashes differ by at most this many bits
+# and their mean levels (0-255) by at most DEDUP_MAX_MEAN
+DEDUP_MAX_DISTANCE = 8
+DEDUP_MAX_MEAN = 2
+
+# A match of the hashes is confirmed on a larger thumbnail, of this size,
+# blurred by CONFIRM_BLUR pixels, where no pixel may be more than
+# DEDUP_MAX_DIFFERENCE levels outside the range of its neighbours in the
+# other thumbnail. The hash alone cannot tell "Chapter 3" from "Chapter 4"
+# on a title card. The blur and the neighbours allow for crops a few pixels
+# apart, as the border of a re-encoded page is not detected at exactly the
+# same place.
+CONFIRM_SIZE = (96, 128)
+CONFIRM_BLUR = 1
+DEDUP_MAX_DIFFERENCE = 16
+
+
+# Thumbnail of cropped pages, levels 0-255
+def page_thumbnail(pages, size):
+    if pages[0][2] == 'uniform':
+        return np.full((size[1], size[0]), float(pages[0][0].getpixel((0, 0))))
+
+    img = pages[0][0]
+    boxes = [box for _, box, _ in pages]
+    box = (min(x[0] for x in boxes), min(x[1] for x in boxes), max(x[2] for x in boxes), max(x[3] for x in boxes))
+    thumb = img.resize(size, Image.BOX, box=box)
+    if thumb.mode == 'I;16':
+        return np.asarray(thumb, dtype=np.float64) / 257
+    return np.asarray(thumb.convert('F'), dtype=np.float64)
+
+
+# Perceptual hash of cropped pages: difference hash of a thumbnail, with the
+# mean level, as the difference hash cannot tell a white page from a black one,
+# and the thumbnail to confirm a match
+# Return: (hash, mean level, confirm thumbnail as 'L' bytes)
+def page_hash(pages):
+    data = page_thumbnail(pages, (HASH_SIZE + 1, HASH_SIZE))
+    bits = np.packbits(data[:, 1:] > data[:, :-1])
+    confirm = Image.fromarray(np.clip(np.round(page_thumbnail(pages, CONFIRM_SIZE)), 0, 255).astype(np.uint8))
+    confirm = confirm.filter(ImageFilter.GaussianBlur(CONFIRM_BLUR))
+    value = 0 if pages[0][2] == 'uniform' else int.from_bytes(bits.tobytes(), 'big')
+    return value, float(np.mean(data)), confirm.tobytes()
+
+
+# Decode stage: open the page (or merge the spread) and crop it
+# Return: edges, cropped buffer, box of every page in the buffer, kind,
+# page hash (None for spreads, or without dedup). A page passed through
+# has no buffer, and its outputs instead of the boxes.
+def decode_stage(task, dedup=False):
+    sources, i, targets, direction = task
+    edges = None
+    phash = None
+    if len(sources) == 2:
+        spread = merge_image(open_image(read_source(sources[0])), open_image(read_source(sources[1])), direction)
+        pages = [crop_page(spread)]
     else:
-        for idx, image in enumerate(images):
-            save_image_mozjpeg(image, output_dir, i, extra='-{}'.format(idx))
+        source = read_source(sources[0])
+        info = probe_image(source)
+        image = open_image(source)
+        if direction is not None and image.width < image.height:
+            edges = image_edges(image)
+
+        # Only passed through here if it is for all targets
+        if all(passthrough_targets(info, image, targets)):
+            return edges, None, [[save_passthrough(source, x[0], i)] for x in targets], None, None
+
+        pages = crop_pages(image, size=info[1:3] if info is not None else None)
+        if dedup:
+            phash = page_hash(pages)
+
+    # Pages of a spread share one buffer
+    return edges, share_array(np.asarray(pages[0][0])), [box for _, box, _ in pages], pages[0][2], phash
+
+
+# Transform stage: resize, gamma and quantize for every target
+# Return: (target index, file name extra, rendered buffer) of every image
+def transform_stage(i, ref, boxes, kind, spread, targets):
+    img = Image.fromarray(take_array(ref))
+    images = []
+    try:
+        for k, (_, d_width, d_height) in enumerate(targets):
+            for idx, box in enumerate(boxes):
+                if spread:
+                    image, extra = render_page((img, box, kind), d_width * 2, d_height), '-{:05d}'.format(i + 2)
+                else:
+                    image, extra = render_page((img, box, kind), d_width, d_height), '-{}'.format(idx) if len(boxes) > 1 else ''
+                images.append((k, extra, share_array(np.asarray(image))))
+    except BaseException:
+        # The page is run again from decode, see staged_imap
+        for _, _, x in images:
+            free_array(x)
+        raise
+    return images
+
+
+# Encode stage: JPEG encode and optimize
+def encode_stage(ref, output_dir, i, extra):
+    return save_image_mozjpeg(Image.fromarray(take_array(ref)), output_dir, i, extra)
+
+
+# Output of a book as a directory. Workers write the files themselves.
+class DirectoryOutput:
+    def __init__(self, path):
+        self.path = path
+        self.outputs = {}
+
+    def worker_dir(self):
+        return self.path
+
+    # Outputs of page i are in, but may still be replaced by a spread
+    def add(self, i, outputs):
+        self.outputs.setdefault(i, []).extend(outputs)
+
+    def discard(self, i):
+        for x in self.outputs.pop(i, []):
+            os.remove(x)
+
+    # Outputs of page i are final
+    def finalize(self, i):
+        self.outputs.pop(i, None)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+# File mode creation mask, read once as reading it means setting it
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+# Output of a book as a ZIP/CBZ file. Workers return JPEG bytes, which are
+# stored (not compressed) in page order. The archive is written to a
+# temporary file next to the output and moved into place when complete.
+class ZipOutput:
+    def __init__(self, path):
+        self.path = path
+        self.tmp = None
+        self.zip = None
+        self.pending = {}
+        self.final = set()
+        self.next = 0
+
+    def worker_dir(self):
+        return None
+
+    def open(self):
+        if self.zip is None:
+            fd, self.tmp = tempfile.mkstemp(prefix='.', suffix='.part', dir=os.path.dirname(os.path.abspath(self.path)))
+            os.close(fd)
+            self.zip = zipfile.ZipFile(self.tmp, 'w', zipfile.ZIP_STORED)
+
+    def add(self, i, outputs):
+        self.pending.setdefault(i, []).extend(outputs)
+
+    def discard(self, i):
+        self.pending.pop(i, None)
+
+    def finalize(self, i):
+        self.open()
+        self.final.add(i)
+        while self.next in self.final:
+            self.final.remove(self.next)
+            for name, data in sorted(self.pending.pop(self.next, [])):
+                self.zip.writestr(name, data)
+            self.next += 1
+
+    def close(self):
+        self.open()
+        # Pages never finalized (failed pages in batch mode) go in as-is
+        for i in sorted(set(self.pending) | self.final):
+            for name, data in sorted(self.pending.pop(i, [])):
+                self.zip.writestr(name, data)
+        self.zip.close()
+        # mkstemp creates the file private
+        os.chmod(self.tmp, 0o666 & ~UMASK)
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        if self.zip is not None:
+            self.zip.close()
+            os.remove(self.tmp)
+
+
+def open_output(path):
+    _, ext = os.path.splitext(path)
+    if ext.lower() in ('.zip', '.cbz'):
+        return ZipOutput(path)
+    return DirectoryOutput(path)
+
+
+# Outputs of a book for every target (output path, d_width, d_height).
+# Results carry one list of outputs per target, in the same order.
+class TargetOutputs:
+    def __init__(self, targets):
+        self.targets = targets
+        self.outputs = [open_output(path) for path, _, _ in targets]
+
+    # Targets as given to the workers
+    def worker_targets(self):
+        return [(output.worker_dir(), d_width, d_height) for output, (_, d_width, d_height) in zip(self.outputs, self.targets)]
+
+    def makedirs(self):
+        for output in self.outputs:
+            if output.worker_dir() is not None:
+                os.makedirs(output.worker_dir(), exist_ok=True)
+
+    def add(self, i, outputs):
+        for output, x in zip(self.outputs, outputs):
+            output.add(i, x)
+
+    def discard(self, i):
+        for output in self.outputs:
+            output.discard(i)
+
+    def finalize(self, i):
+        for output in self.outputs:
+            output.finalize(i)
 
+    def close(self):
+        for output in self.outputs:
+            output.close()
 
-def process_and_save_image_pooled(args):
-    image, i, output_dir, d_width, d_height = args
-    process_and_save_image(image, i, output_dir, d_width, d_height)
+    def abort(self):
+        for output in self.outputs:
+            output.abort()
 
 
-def directory_generator(input_dir):
-    import glob
-    files = [x for e in ['jpg', 'jpeg', 'png', 'gif'] for x in
-             glob.glob(os.path.join(input_dir, '**', '*.{}'.format(e)), recursive=True)]
-    files.sort()
+# Spread merging stage. Workers report the seam edges of every page they
+# process, and pairs are decided in page order with the same heuristic as
+# merge_spread.py. A merged pair has its single-page output replaced by a
+# spread task, so only the pages of a spread are decoded twice.
+class SpreadMerger:
+    def __init__(self, direction, output):
+        self.direction = direction
+        self.output = output
+        self.sources = {}
+        self.pages = {}
+        self.next = 1  # Right page of the next pair to decide
+        self.total = None
+        self.skipped_next_page = False
+        self.spreads = queue.Queue()
+        # Also held around output updates, as set_total runs in the feeder thread
+        self.lock = threading.RLock()
+        self.closed = False
 
+    def add_source(self, i, source):
+        self.sources[i] = source
+
+    def set_total(self, total):
+        with self.lock:
+            self.total = total
+            self.check_done()
+
+    # Called with the result of each page, after adding it to the output
+    def add_page(self, i, edges):
+        with self.lock:
+            self.pages[i] = edges
+            while self.next - 1 in self.pages and self.next in self.pages:
+                self.decide(self.next)
+                self.next += 1
+            self.check_done()
+
+    def decide(self, i):
+        edges0 = self.pages.pop(i - 1)
+        source0 = self.sources.pop(i - 1)
+
+        if self.skipped_next_page:
+            # Page i-1 has already been used in a double-page spread
+            self.skipped_next_page = False
+            return
+
+        edges1 = self.pages[i]
+        if edges0 is not None and edges1 is not None:
+            # This is arbitrary threshold, but it seems to work well
+            pct, contrast = calculate_edges_contrast(self.direction, edges0, edges1)
+            if pct > 0.15 and contrast < 0.25:
+                self.output.discard(i - 1)
+                self.output.discard(i)
+                self.output.finalize(i)
+                self.spreads.put(([source0, self.sources[i]], i - 1))
+                self.skipped_next_page = True
+                return
+
+        self.output.finalize(i - 1)
+
+    def check_done(self):
+        if self.total is None or self.next < self.total:
+            return
+
+        # The last page has no pair left to decide
+        if self.total - 1 in self.pages:
+            self.output.finalize(self.total - 1)
+            self.pages.pop(self.total - 1)
+
+        if not self.closed:
+            self.closed = True
+            self.spreads.put(None)
+
+    def spread_tasks(self, block):
+        while block or not self.spreads.empty():
+            spread = self.spreads.get()
+            if spread is None:
+                return
+            yield spread
+
+
+# Tasks of a book. With a merger, spread tasks are added as pairs are
+# decided; after the last page this waits until every pair is decided,
+# unless wait is False (the caller then gets the rest from the merger).
+def book_tasks(generator, targets, merger=None, wait=True):
+    direction = merger.direction if merger is not None else None
+    count = 0
+    for i, source in generator:
+        if merger is not None:
+            merger.add_source(i, source)
+        count += 1
+        yield [source], i, targets, direction
+
+        if merger is not None:
+            for sources, j in merger.spread_tasks(block=False):
+                yield sources, j, targets, direction
+
+    if merger is not None:
+        merger.set_total(count)
+        if wait:
+            for sources, j in merger.spread_tasks(block=True):
+                yield sources, j, targets, direction
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+
+
+# Sort key putting page2 before page10, ignoring case
+def natural_key(name):
+    return [(0, int(x), x) if x.isdigit() else (1, 0, x.lower()) for x in re.split(r'(\d+)', name) if x != '']
+
+
+# Walk a directory tree in sorted order, yielding image files as they are
+# found. Entries are sorted per directory, with a trailing '/' on
+# directory names, which gives the same order as sorting the full paths.
+def scan_images(path, natural=False):
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                entries.append((entry.name + '/', entry.path, True))
+            elif os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                entries.append((entry.name, entry.path, False))
+
+    entries.sort(key=(lambda x: natural_key(x[0])) if natural else (lambda x: x[0]))
+    for _, entry_path, is_dir in entries:
+        if is_dir:
+            yield from scan_images(entry_path, natural)
+        else:
+            yield entry_path
+
+
+# Pages are yielded while the scan goes on, so the total (ALL) is unknown
+# until it ends
+def directory_generator(input_dir, natural=False):
     global ALL
-    ALL = len(files)
+    ALL = None
 
-    return ((i, Image.open(x)) for i, x in enumerate(files))
+    count = 0
+    for i, x in enumerate(scan_images(input_dir, natural)):
+        count = i + 1
+        yield i, x
+    ALL = count
 
 
-def zip_generator(input_zip):
-    import zipfile
+# Only lists the archive, members are read by the workers (the parent
+# reads only their headers, see probe_source)
+def zip_generator(input_zip, natural=False):
     images_file = []
     with zipfile.ZipFile(input_zip, 'r') as zip_ref:
         for info in zip_ref.infolist():
+            if info.is_dir():
+                continue
             basename = os.path.basename(info.filename)
             if basename[0] != '.' and (info.filename.endswith('.jpg') or info.filename.endswith('.jpeg') or info.filename.endswith('.png')):
                 images_file.append(info.filename)
 
-        # Sort image file
-        images_file.sort()
+    # Sort image file
+    images_file.sort(key=natural_key if natural else None)
 
-        global ALL
-        ALL = len(images_file)
+    global ALL
+    ALL = len(images_file)
 
-        # Process image file
-        for i, file in enumerate(images_file):
-            try:
-                image_blob = zip_ref.read(file)
-                image_io = io.BytesIO(image_blob)
-                image = Image.open(image_io)
-                yield i, image
-            except:
-                print('Error: cannot open image ' + file)
-                raise
+    input_zip = os.path.abspath(input_zip)
+    for i, file in enumerate(images_file):
+        yield i, (input_zip, file)
 
 
 def azw3_generator(input_azw3):
@@ -198,63 +1076,1039 @@ def azw3_generator(input_azw3):
     global ALL
     ALL = len(images)
 
+    # Images are read here, as tmpdir is removed once this generator ends
     for i, image in enumerate(images):
-        yield i, Image.open(image)
+        with open(image, 'rb') as f:
+            yield i, f.read()
+
+
+# Add a task result to the output of a book
+# Return: True if the result is a page (not a merged spread)
+def handle_result(output, merger, i, edges, outputs):
+    if merger is None:
+        output.add(i, outputs)
+        output.finalize(i)
+        return True
+
+    with merger.lock:
+        output.add(i, outputs)
+
+        # Pages are in merger.sources until decided, spreads are not
+        if i in merger.sources:
+            merger.add_page(i, edges)
+            return True
+
+        output.finalize(i)
+        return False
+
+
+# Pages seen by the staged pipeline, by perceptual hash. A page matching
+# an earlier one reuses its output ('reuse') or is left out ('drop').
+class DuplicatePages:
+    def __init__(self, mode):
+        self.mode = mode
+        self.originals = {}  # key: (hash, mean, confirm thumbnail, number of pages, page index)
+        self.duplicates = {}  # key: (page index, original page index)
+
+    # Pages must be matched in page order, so the original is the first one
+    # Return: key of the original of the page, None if it is not a duplicate
+    def match(self, key, i, phash, count):
+        value, mean, confirm = phash
+        for original, (value0, mean0, confirm0, count0, i0) in self.originals.items():
+            if count == count0 and abs(mean - mean0) <= DEDUP_MAX_MEAN and bin(value ^ value0).count('1') <= DEDUP_MAX_DISTANCE \
+                    and same_thumbnail(confirm, confirm0):
+                self.duplicates[key] = (i, i0)
+                return original
+        self.originals[key] = (value, mean, confirm, count, i)
+        return None
+
+    # The page was processed after all
+    def unmatch(self, key):
+        self.duplicates.pop(key, None)
+
+    # The page failed, later pages are not matched with it
+    def discard(self, key):
+        self.originals.pop(key, None)
+
+    def report(self):
+        if len(self.duplicates) == 0:
+            print('No duplicate pages')
+            return
+        action = 'dropped' if self.mode == 'drop' else 'reused'
+        print('Duplicate pages ({}):'.format(action))
+        for i, i0 in sorted(self.duplicates.values()):
+            print('  page {:5d}: same as page {}'.format(i + 1, i0 + 1))
+
+
+# Compare confirm thumbnails of page_hash, see CONFIRM_SIZE
+def same_thumbnail(data0, data1):
+    shape = (CONFIRM_SIZE[1], CONFIRM_SIZE[0])
+    a = np.frombuffer(data0, dtype=np.uint8).reshape(shape).astype(np.int16)
+    b = np.frombuffer(data1, dtype=np.uint8).reshape(shape).astype(np.int16)
+    return neighbour_excess(a, b) <= DEDUP_MAX_DIFFERENCE and neighbour_excess(b, a) <= DEDUP_MAX_DIFFERENCE
+
+
+# Largest amount by which a pixel of a is outside the range of the 3x3
+# neighbourhood of the same pixel in b
+def neighbour_excess(a, b):
+    padded = np.pad(b, 1, mode='edge')
+    height, width = b.shape
+    neighbours = np.stack([padded[y:y + height, x:x + width] for y in range(3) for x in range(3)])
+    return int(max(np.amax(np.amin(neighbours, axis=0) - a), np.amax(a - np.amax(neighbours, axis=0))))
+
+
+# Outputs of page i, for a page that duplicates it: files are copied and
+# archive entries renamed
+def reuse_outputs(outputs, i):
+    prefix = '{:05d}'.format(i + 1)
+    result = []
+    for target_outputs in outputs:
+        reused = []
+        for x in target_outputs:
+            if isinstance(x, tuple):
+                reused.append((re.sub(r'^\d+', prefix, x[0]), x[1]))
+            else:
+                name = os.path.join(os.path.dirname(x), re.sub(r'^\d+', prefix, os.path.basename(x)))
+                shutil.copyfile(x, name)
+                reused.append(name)
+        result.append(reused)
+    return result
+
+
+# CPU and memory limits. In a container, the cgroup limits are what the
+# scheduler must fit in, not the CPUs and memory of the host.
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# Fraction of the available memory pages may use, the rest is left for
+# the JPEG encoder, the output and the page cache
+MEMORY_HEADROOM = 0.75
+
+# Memory of an idle worker process (interpreter, NumPy, Pillow)
+WORKER_MEMORY = 48 * 1024 * 1024
+
+# Working set assumed for a page whose header cannot be read
+DEFAULT_PAGE_MEMORY = 64 * 1024 * 1024
+
+# Bytes per pixel of a working image, and of a page rendered for a target
+# (gamma is computed in 64-bit floating point)
+WORKING_BYTES = {'float': 4, '16': 2, '8': 1}
+RENDER_BYTES = 32
+
+# Seconds between memory checks while a task waits for memory
+MEMORY_POLL_INTERVAL = 0.5
+
+
+# Directories of the cgroup of this process for a controller, innermost
+# first, up to the root: limits of every parent cgroup apply as well
+def cgroup_dirs(controller):
+    roots = []
+    try:
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                _, controllers, path = line.rstrip('\n').split(':', 2)
+                if controllers == '':
+                    roots.append((CGROUP_ROOT, path))
+                elif controller in controllers.split(','):
+                    roots.append((os.path.join(CGROUP_ROOT, controllers), path))
+    except (OSError, ValueError):
+        return []
+
+    dirs = []
+    for root, path in roots:
+        parts = [x for x in path.split('/') if x != '']
+        for n in range(len(parts), -1, -1):
+            path = os.path.join(root, *parts[:n])
+            if os.path.isdir(path) and path not in dirs:
+                dirs.append(path)
+    return dirs
+
+
+# Content of a cgroup file, or None
+def read_cgroup_file(path, name):
+    try:
+        with open(os.path.join(path, name)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+# CPU quota of the cgroup (cgroup v2 cpu.max or v1 CFS quota), in CPUs,
+# or None if unlimited
+def cgroup_cpu_quota():
+    quotas = []
+    for path in cgroup_dirs('cpu'):
+        value = read_cgroup_file(path, 'cpu.max')
+        if value is not None and not value.startswith('max'):
+            quota, period = value.split()
+            quotas.append(int(quota) / int(period))
+        quota = read_cgroup_file(path, 'cpu.cfs_quota_us')
+        period = read_cgroup_file(path, 'cpu.cfs_period_us')
+        if quota is not None and period is not None and int(quota) > 0:
+            quotas.append(int(quota) / int(period))
+    return min(quotas) if len(quotas) > 0 else None
+
+
+# CPUs this process may use: its CPU affinity, within the cgroup quota
+def cpu_limit():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+# Memory left below the cgroup limit (cgroup v2 memory.max or v1
+# memory.limit_in_bytes), or None if unlimited. Inactive page cache can be
+# reclaimed, so it is not counted as used.
+def cgroup_memory_free():
+    free = []
+    for path in cgroup_dirs('memory'):
+        limit = read_cgroup_file(path, 'memory.max') or read_cgroup_file(path, 'memory.limit_in_bytes')
+        usage = read_cgroup_file(path, 'memory.current') or read_cgroup_file(path, 'memory.usage_in_bytes')
+        if limit is None or usage is None or limit == 'max' or int(limit) >= 1 << 60:
+            continue
+        inactive = 0
+        for line in (read_cgroup_file(path, 'memory.stat') or '').splitlines():
+            name, _, value = line.partition(' ')
+            if name in ('inactive_file', 'total_inactive_file'):
+                inactive = int(value)
+        free.append(int(limit) - max(0, int(usage) - inactive))
+    return max(0, min(free)) if len(free) > 0 else None
+
+
+# Memory available to this process now: the lower of the cgroup limit and
+# MemAvailable of the system, or None if unknown
+def memory_available():
+    available = [cgroup_memory_free()]
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available.append(int(line.split()[1]) * 1024)
+    except (OSError, ValueError):
+        pass
+    available = [x for x in available if x is not None]
+    return min(available) if len(available) > 0 else None
+
+
+# Estimated peak memory of processing a page of a given header (from
+# probe_source) for the targets: the decoded page, its 'L' and working
+# copies (or bands for a tiled page), and the pages rendered per target
+def page_memory(info, targets):
+    if info is None or info[1] <= 0 or info[2] <= 0:
+        return DEFAULT_PAGE_MEMORY
+    _, width, height, mode = info
+    pixels = width * height
+    channels = {'L': 1, '1': 1, 'P': 1, 'I;16': 2, 'CMYK': 4, 'RGBA': 4}.get(mode, 3)
+    per_pixel = channels + 1 + 2 * WORKING_BYTES[PRECISION]
+    if pixels > TILED_PIXELS:
+        working = pixels * channels + TILE_PIXELS * per_pixel
+    else:
+        working = pixels * per_pixel
+    # A landscape page is rendered as two pages
+    rendered = sum(w * h for _, w, h in targets) * RENDER_BYTES * (2 if width >= height else 1)
+    return working + rendered
+
+
+# Estimated peak memory of a task (see process_task). A spread is merged
+# from two decoded pages into an RGB image, twice the target width.
+def task_memory(task):
+    sources, i, targets, direction = task
+    infos = [probe_source(x) for x in sources]
+    if len(infos) == 1:
+        return page_memory(infos[0], targets)
+    if any(x is None for x in infos):
+        return 2 * DEFAULT_PAGE_MEMORY
+    decoded = sum(x[1] * x[2] * 3 for x in infos)
+    return decoded + page_memory(('jpeg', infos[0][1] + infos[1][1], max(infos[0][2], infos[1][2]), 'RGB'), targets)
+
+
+# Worker processes for the page pool: a worker per CPU within the cgroup
+# quota, but no more than the available memory can hold with a page each
+def worker_count():
+    workers = cpu_limit()
+    available = memory_available()
+    if available is not None:
+        workers = min(workers, int(available * MEMORY_HEADROOM) // (WORKER_MEMORY + DEFAULT_PAGE_MEMORY))
+    return max(1, workers)
+
+
+# Admits tasks to a worker pool while their estimated memory (task_memory)
+# fits in a budget taken from the memory available when the pool started,
+# and in the memory available now, which may have gone down since. At most
+# `pending` tasks are queued. A task is always admitted when none is
+# running, so a page larger than the budget still runs, alone.
+class MemoryScheduler:
+    def __init__(self, workers):
+        self.pending = workers * 4
+        available = memory_available()
+        self.budget = int(available * MEMORY_HEADROOM) if available is not None else None
+        self.in_use = 0
+        self.costs = {}  # key: memory of the task
+        self.next_key = 0
+        self.condition = threading.Condition()
+
+    def fits(self, cost):
+        if len(self.costs) >= self.pending:
+            return False
+        if self.budget is None:
+            return True
+        if self.in_use + cost > self.budget:
+            return False
+        available = memory_available()
+        return available is None or cost <= int(available * MEMORY_HEADROOM)
+
+    def admit(self, cost):
+        with self.condition:
+            while len(self.costs) > 0 and not self.fits(cost):
+                # Memory may be freed by others, so check again from time to time
+                self.condition.wait(MEMORY_POLL_INTERVAL)
+            key = self.next_key
+            self.next_key += 1
+            self.costs[key] = cost
+            self.in_use += cost
+            return key
+
+    def release(self, key):
+        with self.condition:
+            self.in_use -= self.costs.pop(key)
+            self.condition.notify_all()
+
+
+# Pages running longer than this many seconds are stopped (--timeout),
+# None is no limit. Needs worker processes, threads cannot be stopped.
+PAGE_TIMEOUT = None
+
+# A page that fails or times out is run this many more times
+PAGE_RETRIES = 1
+
+# Worker processes are replaced after this many tasks, so memory
+# fragmented by large pages is given back
+WORKER_MAX_TASKS = 100
+
+# Seconds between timeout checks
+WATCHDOG_INTERVAL = 1.0
+
+
+# Run a task of run_tasks in a worker
+def run_scheduled(args):
+    tag, func, item = args
+    return tag, func(item)
+
+
+# Run func(item) for every item in a pool from new_pool(), as the
+# scheduler (MemoryScheduler) admits them. At most a task per worker is
+# submitted at a time, so a task runs from when it is submitted. A task
+# that raises or runs past PAGE_TIMEOUT is run again, up to PAGE_RETRIES
+# times. On a timeout, the pool is terminated, as a single worker of a
+# pool cannot be stopped safely, and the other running tasks are submitted
+# again to a new pool.
+# Yield: item, result, error (None, or the error of the last run as text)
+def run_tasks(new_pool, workers, scheduler, items, func, cost):
+    events = queue.Queue()
+
+    # Runs in its own thread, as items may wait for merge decisions
+    def feed():
+        count = 0
+        try:
+            for item in items:
+                events.put(('queued', scheduler.admit(cost(item)), item))
+                count += 1
+        except BaseException as e:
+            events.put(('error', None, e))
+        events.put(('fed', None, count))
+
+    pool = new_pool()
+    try:
+        threading.Thread(target=feed, daemon=True).start()
+
+        tasks = {}  # key: [item, runs, submission, submit time]
+        backlog = collections.deque()
+        submissions = 0
+
+        def submit(key):
+            nonlocal submissions
+            submissions += 1
+            tag = key, submissions
+            tasks[key][2:] = [submissions, time.monotonic()]
+            pool.apply_async(run_scheduled, ((tag, func, tasks[key][0]),),
+                             callback=lambda r: events.put(('done', r[0], r[1])),
+                             error_callback=lambda e: events.put(('failed', tag, e)))
+
+        total = None
+        done = 0
+        while total is None or done < total:
+            try:
+                kind, tag, value = events.get(timeout=WATCHDOG_INTERVAL if PAGE_TIMEOUT is not None else None)
+            except queue.Empty:
+                kind = None
 
+            finished = []
+            if kind == 'error':
+                raise value
+            if kind == 'fed':
+                total = value
+            elif kind == 'queued':
+                tasks[tag] = [value, 0, None, None]
+                backlog.append(tag)
+            elif kind is not None:
+                key, submission = tag
+                if key in tasks and tasks[key][2] == submission:
+                    if kind == 'done':
+                        finished.append((key, value, None))
+                    else:
+                        finished.append((key, None, '{}: {}'.format(type(value).__name__, value)))
+
+            if PAGE_TIMEOUT is not None:
+                now = time.monotonic()
+                expired = [x for x, task in tasks.items() if task[2] is not None and now - task[3] > PAGE_TIMEOUT]
+                if len(expired) > 0:
+                    pool.terminate()
+                    pool = new_pool()
+                    for key, task in tasks.items():
+                        if task[2] is not None and key not in expired:
+                            submit(key)
+                    finished.extend((x, None, 'timed out after {} s'.format(PAGE_TIMEOUT)) for x in expired)
+
+            for key, result, error in finished:
+                task = tasks[key]
+                task[2] = None
+                if error is not None and task[1] < PAGE_RETRIES:
+                    task[1] += 1
+                    backlog.appendleft(key)
+                    continue
+                del tasks[key]
+                scheduler.release(key)
+                done += 1
+                yield task[0], result, error
+
+            running = sum(1 for x in tasks.values() if x[2] is not None)
+            while len(backlog) > 0 and running < workers:
+                submit(backlog.popleft())
+                running += 1
+    finally:
+        pool.terminate()
+
+
+# Result of a task that failed: the page has no output
+def failed_result(task):
+    return task[1], None, [[] for _ in task[2]]
+
+
+def default_stages():
+    cpus = cpu_limit()
+    return [max(1, cpus // 2), cpus, cpus]
+
+
+# Run tasks through the staged pipeline, with (decode, transform, encode)
+# workers per stage. Only a few decoded pages are held at a time, so the
+# decode stage is bounded in memory while the later stages keep cores busy.
+# With duplicates (DuplicatePages), pages are hashed at decode and a
+# duplicate page skips transform and encode. A page that fails in any
+# stage is run again up to PAGE_RETRIES times, then yielded without outputs
+# and added to failed as (page index, error), as page_results.
+# Yield: page index, edges, output files of each target, as process_task
+def staged_imap(tasks, stages, duplicates=None, failed=None):
+    from multiprocessing import resource_tracker
+
+    # Blocks are created and freed in different workers, which must all
+    # report to the same resource tracker
+    resource_tracker.ensure_running()
+
+    if failed is None:
+        failed = []
+    events = queue.Queue()
+    decoded_slots = threading.Semaphore(stages[0] * 2)
+    running = {}
+
+    def submit(pool, func, args, kind, key):
+        pool.apply_async(func, args,
+                         callback=lambda r: events.put((kind, key, r)),
+                         error_callback=lambda e: events.put(('failed', key, (kind, e))))
+
+    # Runs in its own thread, as book_tasks may wait for merge decisions
+    def feed(decode_pool):
+        count = 0
+        try:
+            for task in tasks:
+                decoded_slots.acquire()
+                running[count] = task
+                submit(decode_pool, decode_stage, (task, duplicates is not None), 'decoded', count)
+                count += 1
+        except BaseException as e:
+            events.put(('error', None, e))
+        events.put(('fed', None, count))
+
+    with open_pool(processes=stages[0]) as decode_pool, open_pool(processes=stages[1]) as transform_pool, \
+            open_pool(processes=stages[2]) as encode_pool:
+        threading.Thread(target=feed, args=(decode_pool,), daemon=True).start()
+
+        # Rendered pages are held in shared memory until encoded, so at most
+        # rendering_limit pages are between transform and the end of encode.
+        # Other decoded pages wait here, keeping their decode slot.
+        rendering_limit = stages[2] * 2
+        rendering = set()
+        transform_waiting = collections.deque()
+
+        def transform(key, ref, boxes, kind):
+            if len(rendering) >= rendering_limit:
+                transform_waiting.append((key, ref, boxes, kind))
+                return
+            rendering.add(key)
+            sources, i, targets, direction = running[key]
+            submit(transform_pool, transform_stage, (i, ref, boxes, kind, len(sources) == 2, targets), 'transformed', key)
+
+        # The rendered images of a page are encoded, or it failed
+        def transform_done(key):
+            rendering.discard(key)
+            if len(transform_waiting) > 0:
+                transform(*transform_waiting.popleft())
+
+        # Give a duplicate page the outputs of its original
+        def reuse(key, original, ref, boxes, kind):
+            try:
+                pages[key][1] = reuse_outputs(finished[original], running[key][1])
+            except OSError:
+                # Output of the original is gone (merged into a spread)
+                duplicates.unmatch(key)
+                transform(key, ref, boxes, kind)
+                return
+            free_array(ref)
+            release(key)
+            ready.append(key)
+
+        # Give back the decode slot of a page
+        def release(key):
+            if key in unslotted:
+                unslotted.discard(key)
+            else:
+                decoded_slots.release()
+
+        # Decide what to do with a decoded page. A page run again after a
+        # failure keeps its earlier decision.
+        def decide(key, value):
+            edges, ref, boxes, kind, phash = value
+            targets = running[key][2]
+            pages[key] = [edges, [[] for _ in targets], 0, None]
+            original = None
+            if duplicates is not None and phash is not None and key not in retried:
+                original = duplicates.match(key, running[key][1], phash, len(boxes))
+            if ref is None:
+                # Passed through
+                pages[key][1] = boxes
+                release(key)
+                ready.append(key)
+            elif original is None:
+                transform(key, ref, boxes, kind)
+            elif duplicates.mode == 'drop':
+                free_array(ref)
+                release(key)
+                ready.append(key)
+            elif original in finished:
+                reuse(key, original, ref, boxes, kind)
+            else:
+                waiting.setdefault(original, []).append((key, original, ref, boxes, kind))
+
+        # Pages are matched in page order, so the original of equal pages is
+        # always the first one, whichever page finishes decoding first. A
+        # page that failed for good is None.
+        def decide_in_order(key, value):
+            nonlocal next_key
+            decoded[key] = value
+            while next_key in decoded:
+                value = decoded.pop(next_key)
+                if value is not None:
+                    decide(next_key, value)
+                next_key += 1
+
+        # A stage of a page failed: the page is run again from decode, up to
+        # PAGE_RETRIES times, then left out without outputs. The page holds
+        # its decode slot until it is transformed.
+        def fail(key, stage, error):
+            decided = key in pages or key in retried
+            page = pages.pop(key, None)
+            if runs.get(key, 0) < PAGE_RETRIES:
+                runs[key] = runs.get(key, 0) + 1
+                if decided:
+                    retried.add(key)
+                if stage == 'encoded':
+                    unslotted.add(key)
+                submit(decode_pool, decode_stage, (running[key], duplicates is not None), 'decoded', key)
+                return
+
+            if stage != 'encoded':
+                release(key)
+            if page is not None:
+                for x in [x for outputs in page[1] for x in outputs]:
+                    if isinstance(x, str) and os.path.exists(x):
+                        os.remove(x)
+            failed.append((running[key][1], error))
+            pages[key] = [None, [[] for _ in running[key][2]], 0, None]
+            ready.append(key)
+            if duplicates is not None:
+                duplicates.discard(key)
+                for x in waiting.pop(key, []):
+                    duplicates.unmatch(x[0])
+                    transform(x[0], *x[2:])
+                if not decided:
+                    decide_in_order(key, None)
+
+        total = None
+        done = 0
+        pages = {}
+        finished = {}  # Outputs of original pages, by key
+        waiting = {}  # Duplicates waiting for their original, by key of the original
+        decoded = {}  # Decoded pages waiting for the pages before them, by key
+        next_key = 0
+        runs = {}  # Number of times a page was run again, by key
+        retried = set()  # Pages run again after they were decided
+        unslotted = set()  # Pages run again after giving back their decode slot
+        while total is None or done < total:
+            kind, key, value = events.get()
+            if kind == 'error':
+                raise value
+            if kind == 'fed':
+                total = value
+                continue
+
+            ready = []
+            sources, i, targets, direction = running[key]
+            if kind == 'failed':
+                stage, error = value
+                error = '{}: {}'.format(type(error).__name__, error)
+                if stage == 'transformed':
+                    transform_done(key)
+                if isinstance(stage, tuple):
+                    # Other images of the page may still be encoding
+                    pages[key][2] -= 1
+                    pages[key][3] = error
+                    if pages[key][2] == 0:
+                        transform_done(key)
+                        fail(key, 'encoded', error)
+                else:
+                    fail(key, stage, error)
+            elif kind == 'decoded':
+                if duplicates is None or key in retried:
+                    decide(key, value)
+                else:
+                    decide_in_order(key, value)
+            elif kind == 'transformed':
+                release(key)
+                pages[key][2] = len(value)
+                for k, extra, ref in value:
+                    submit(encode_pool, encode_stage, (ref, targets[k][0], i, extra), ('encoded', k), key)
+            else:
+                page = pages[key]
+                page[1][kind[1]].append(value)
+                page[2] -= 1
+                if page[2] == 0 and page[3] is not None:
+                    transform_done(key)
+                    fail(key, 'encoded', page[3])
+                elif page[2] == 0:
+                    page[1] = [sorted(x) for x in page[1]]
+                    ready.append(key)
+                    transform_done(key)
+                    if duplicates is not None and key in duplicates.originals:
+                        finished[key] = page[1]
+                        for x in waiting.pop(key, []):
+                            reuse(*x)
+
+            for x in ready:
+                edges, outputs, _, _ = pages.pop(x)
+                i = running.pop(x)[1]
+                runs.pop(x, None)
+                retried.discard(x)
+                done += 1
+                yield i, edges, outputs
+
+
+# Worker pool for page tasks: a process per worker, or with threads, a
+# thread per worker in this process. Pillow, NumPy and the JPEG encoder
+# release the GIL for most of the work, and threads share one copy of
+# the interpreter and modules. threads=0 is a thread per CPU.
+# See pool_size for the default number of workers.
+def open_pool(threads=None, processes=None):
+    if threads is not None:
+        from multiprocessing.pool import ThreadPool
+        return ThreadPool(threads or cpu_limit())
 
-def process_with_generator(generator, output_dir, d_width, d_height):
     from multiprocessing import Pool
-    os.makedirs(output_dir, exist_ok=True)
-    with Pool() as pool:
-        r = pool.imap_unordered(process_and_save_image_pooled,
-                                ((image, i, output_dir, d_width, d_height) for i, image in generator))
-
-        # Drain the pool
-        CNT = 0
-        print('Processing images...', end='\r', flush=True)
-        for x in r:
+    return Pool(processes or worker_count(), initializer=init_worker, initargs=(worker_settings(),),
+                maxtasksperchild=WORKER_MAX_TASKS)
+
+
+# Number of workers of open_pool(threads)
+def pool_size(threads=None):
+    if threads is not None:
+        return threads or cpu_limit()
+    return worker_count()
+
+
+# Results of run_tasks for drain_results. A failed page has no output, and
+# is added to failed as (page index, error).
+def page_results(r, failed):
+    for task, result, error in r:
+        if error is not None:
+            failed.append((task[1], error))
+            result = failed_result(task)
+        yield result
+
+
+# Add results to the output as they come, with progress
+def drain_results(output, merger, r):
+    CNT = 0
+    print('Processing images...', end='\r', flush=True)
+    for i, edges, outputs in r:
+        if handle_result(output, merger, i, edges, outputs):
             CNT += 1
-            print('Processing images... {:5d}/{}'.format(CNT, ALL), end='\r', flush=True)
-        print('Done!                               ')
+            print('Processing images... {:5d}/{}'.format(CNT, ALL or '?'), end='\r', flush=True)
+
+
+# Targets: list of (output path, d_width, d_height), pages are decoded once
+# for all of them. With stages, the staged pipeline is used instead of a
+# worker per page, see staged_imap. See open_pool for threads.
+# Duplicate pages ('reuse' or 'drop' as dedup) are found in the staged
+# pipeline, which is then used with default stages.
+# Pages that fail are left out and reported at the end.
+# Return: True if every page was converted
+def process_with_generator(generator, targets, direction=None, stages=None, threads=None, dedup=None):
+    output = TargetOutputs(targets)
+    output.makedirs()
+    merger = SpreadMerger(direction, output) if direction is not None else None
+    duplicates = DuplicatePages(dedup) if dedup is not None else None
+    failed = []
+    if duplicates is not None and stages is None:
+        stages = default_stages()
+    try:
+        tasks = book_tasks(generator, output.worker_targets(), merger)
+        if stages is not None:
+            drain_results(output, merger, staged_imap(tasks, stages, duplicates, failed))
+        else:
+            workers = pool_size(threads)
+            r = run_tasks(lambda: open_pool(threads, workers), workers, MemoryScheduler(workers), tasks, process_task, task_memory)
+            drain_results(output, merger, page_results(r, failed))
+    except BaseException:
+        output.abort()
+        raise
+
+    output.close()
+    print('Done!                               ')
+    if duplicates is not None:
+        duplicates.report()
+    if len(failed) > 0:
+        print('Failed: {} pages'.format(len(failed)))
+        for i, error in sorted(failed):
+            print('  page {:5d}: {}'.format(i + 1, error))
+    return len(failed) == 0
+
+
+# A single input of a batch run
+class Book:
+    def __init__(self, index, input_path, targets, direction=None):
+        self.index = index
+        self.input_path = input_path
+        self.output = TargetOutputs(targets)
+        self.merger = SpreadMerger(direction, self.output) if direction is not None else None
+        self.pages = 0
+        self.queued = 0
+        self.total = None  # Set once all tasks are queued
+        self.done = 0
+        self.failed = []
+        self.error = None
+        self.closed = False
+
+    def name(self):
+        return os.path.basename(os.path.normpath(self.input_path))
+
+    def finished(self):
+        return self.total is not None and self.done == self.total
+
+
+# Tasks of all books. With a merger, the next book is started without
+# waiting for the pairs of the previous one: their spread tasks are added
+# between the pages of the next books, and only waited for at the end.
+def batch_tasks(books, natural=False):
+    merging = []  # Books whose merger may still add spread tasks
+
+    def spread_tasks(block):
+        for book in list(merging):
+            for sources, j in book.merger.spread_tasks(block):
+                book.queued += 1
+                yield book.index, (sources, j, book.output.worker_targets(), book.merger.direction)
+            # Spread tasks are all added before the merger is closed
+            if block or (book.merger.closed and book.merger.spreads.empty()):
+                merging.remove(book)
+                book.total = book.queued
+
+    for book in books:
+        try:
+            generator = open_generator(book.input_path, natural)
+            if generator is None:
+                raise ValueError('Unsupported input file type')
+            for task in book_tasks(generator, book.output.worker_targets(), book.merger, wait=False):
+                if book.queued == 0:
+                    book.output.makedirs()
+                book.queued += 1
+                if len(task[0]) == 1:
+                    book.pages += 1
+                yield book.index, task
+                yield from spread_tasks(block=False)
+        except Exception as e:
+            book.error = '{}: {}'.format(type(e).__name__, e)
+        finally:
+            if book.merger is None or book.error is not None:
+                book.total = book.queued
+            else:
+                merging.append(book)
+
+    yield from spread_tasks(block=True)
+
+
+def print_book_result(book):
+    if book.error is not None:
+        print('Failed: {} ({})'.format(book.name(), book.error))
+    elif len(book.failed) > 0:
+        print('Failed: {} ({} of {} pages)'.format(book.name(), len(book.failed), book.pages))
+        for i, error in sorted(book.failed):
+            print('  page {:5d}: {}'.format(i + 1, error))
+    else:
+        print('Done: {} ({} pages)'.format(book.name(), book.pages))
+
+
+def close_book(book):
+    book.closed = True
+    if book.error is None:
+        book.output.close()
+    else:
+        book.output.abort()
+    print_book_result(book)
+
+
+# Process many books through one pool. Pages of the next book are read
+# (and AZW3 unpacked) while the pool still works on the current one.
+def process_batch(inputs, output_root, d_width, d_height, direction=None, output_ext='', natural=False, threads=None):
+    books = []
+    names = set()
+    for index, input_path in enumerate(inputs):
+        name = os.path.splitext(os.path.basename(os.path.normpath(input_path)))[0]
+        unique_name, n = name, 1
+        while unique_name in names:
+            n += 1
+            unique_name = '{}-{}'.format(name, n)
+        names.add(unique_name)
+        books.append(Book(index, input_path, [(os.path.join(output_root, unique_name + output_ext), d_width, d_height)], direction))
+
+    os.makedirs(output_root, exist_ok=True)
+
+    # Only a few pages are held in memory, see MemoryScheduler. Failed
+    # pages are reported with their book instead of stopping the batch.
+    workers = pool_size(threads)
+    r = run_tasks(lambda: open_pool(threads, workers), workers, MemoryScheduler(workers),
+                  batch_tasks(books, natural), process_book_task, lambda x: task_memory(x[1]))
+
+    for (book_index, task), result, error in r:
+        i, edges, outputs = result[1] if error is None else failed_result(task)
+        book = books[book_index]
+        book.done += 1
+        if error is not None:
+            book.failed.append((i, error))
+        handle_result(book.output, book.merger, i, edges, outputs)
+        print('Processing {}... {:5d}/{}'.format(book.name(), book.done, book.total or '?'), end='\r', flush=True)
+
+        # With a merger, the total of a book is only set once its last
+        # pair is decided, which can be after its last result
+        for x in books:
+            if not x.closed and x.finished():
+                close_book(x)
+
+    # Books without any processed page, or finished with the last result
+    for book in books:
+        if not book.closed:
+            close_book(book)
+
+    failed = [x for x in books if x.error is not None or len(x.failed) > 0]
+    print('Batch done: {} of {} books converted'.format(len(books) - len(failed), len(books)))
+    return len(failed) == 0
+
+
+def open_generator(input_path, natural=False):
+    if os.path.isdir(input_path):
+        return directory_generator(input_path, natural)
+
+    _, ext = os.path.splitext(input_path)
+    if ext == '.zip' or ext == '.cbz':
+        return zip_generator(input_path, natural)
+    if ext == '.azw3':
+        return azw3_generator(input_path)
+
+    return None
+
+
+# Split `--name` and `--name=value` options from positional arguments
+def parse_options(argv):
+    options = {}
+    args = []
+    for x in argv:
+        if x.startswith('--'):
+            name, _, value = x[2:].partition('=')
+            options[name] = value if value else True
+        else:
+            args.append(x)
+    return options, args
+
+
+def usage():
+    print('Usage: python convert-comic.py [options] <width> <height> <input-dir> <output-dir> [<width> <height> <output-dir>]...')
+    print('       python convert-comic.py --batch [options] <width> <height> <output-dir> <input>...')
+    print()
+    print('Options:')
+    print('  --merge-spread=<ltr|rtl>  Merge double-page spreads split into two pages')
+    print('  --cbz                     Batch mode: write each book as <output-dir>/<name>.cbz')
+    print('  --natural-sort            Sort page2 before page10')
+    print('  --staged[=<d>,<t>,<e>]    Decode, transform and encode in separate pools')
+    print('                            with <d>, <t> and <e> workers (not in batch mode)')
+    print('  --threads[=<n>]           Use <n> worker threads instead of worker processes')
+    print('  --exact-resize            Resize with LANCZOS only, without integer pre-reduction')
+    print('  --precision=<float|16|8>  Precision of pages between conversion and gamma')
+    print('  --passthrough[=<copy|optimize>]')
+    print('                            Copy pages already converted for the device as-is')
+    print('                            (or with only the lossless mozjpeg pass)')
+    print('  --dedup[=<reuse|drop>]    Reuse the output of repeated pages, or drop them')
+    print('                            (uses the staged pipeline, not in batch mode)')
+    print('  --timeout=<seconds>       Stop pages running longer than this, and run them')
+    print('                            once more (not with --threads or --staged)')
+    print()
+    print('An output ending with .cbz or .zip is written as an archive instead of a directory.')
+    print('Extra <width> <height> <output-dir> targets reuse the decoded and cropped pages.')
 
 
 def main(argv):
+    options, argv = parse_options(argv)
     if len(argv) < 5:
-        print('Usage: python convert-comic.py <width> <height> <input-dir> <output-dir>')
+        usage()
         return
 
     width = int(argv[1])
     height = int(argv[2])
 
+    natural = bool(options.get('natural-sort'))
+
+    direction = None
+    if 'merge-spread' in options:
+        direction = {'ltr': 1, 'rtl': -1}.get(options['merge-spread'])
+        if direction is None:
+            usage()
+            return
+
+    threads = None
+    if 'threads' in options:
+        try:
+            threads = 0 if options['threads'] is True else max(1, int(options['threads']))
+        except ValueError:
+            usage()
+            return
+        if 'staged' in options or 'dedup' in options:
+            usage()
+            return
+
+    # Both need the staged pipeline, which batch mode does not use
+    if options.get('batch') and ('staged' in options or 'dedup' in options):
+        usage()
+        return
+
+    global REDUCING_GAP, PRECISION, PASSTHROUGH, PAGE_TIMEOUT
+    if 'timeout' in options:
+        try:
+            PAGE_TIMEOUT = float(options['timeout']) if options['timeout'] is not True else 0
+        except ValueError:
+            usage()
+            return
+        if PAGE_TIMEOUT <= 0 or threads is not None or 'staged' in options or 'dedup' in options:
+            usage()
+            return
+    if 'passthrough' in options:
+        PASSTHROUGH = 'copy' if options['passthrough'] is True else options['passthrough']
+        if PASSTHROUGH not in ('copy', 'optimize'):
+            usage()
+            return
+    if options.get('exact-resize'):
+        REDUCING_GAP = None
+    if 'precision' in options:
+        if options['precision'] not in WORKING_MODES:
+            usage()
+            return
+        PRECISION = options['precision']
+
     print('convert-comic.py: Comic Preparation tool for Kindle Create')
-    print('  size: {}x{}'.format(width, height))
+
+    if options.get('batch'):
+        print('  size: {}x{}'.format(width, height))
+        print()
+
+        output_root, inputs = argv[3], argv[4:]
+        if os.path.exists(output_root) and not os.path.isdir(output_root):
+            print('Output is not a directory: {}'.format(output_root), file=sys.stderr)
+            return
+
+        output_ext = '.cbz' if options.get('cbz') else ''
+        if not process_batch(inputs, output_root, width, height, direction, output_ext, natural, threads):
+            sys.exit(1)
+        return
+
+    stages = None
+    if 'staged' in options:
+        if options['staged'] is True:
+            stages = default_stages()
+        else:
+            try:
+                stages = [max(1, int(x)) for x in options['staged'].split(',')]
+            except ValueError:
+                stages = []
+            if len(stages) != 3:
+                usage()
+                return
+
+    dedup = None
+    if 'dedup' in options:
+        dedup = 'reuse' if options['dedup'] is True else options['dedup']
+        if dedup not in ('reuse', 'drop'):
+            usage()
+            return
+
+    # Extra targets follow as <width> <height> <output-dir>
+    if (len(argv) - 5) % 3 != 0:
+        usage()
+        return
+    targets = [(argv[4], width, height)]
+    for k in range(5, len(argv), 3):
+        targets.append((argv[k + 2], int(argv[k]), int(argv[k + 1])))
+
+    for output_path, d_width, d_height in targets:
+        print('  size: {}x{}'.format(d_width, d_height) + ('  -> {}'.format(output_path) if len(targets) > 1 else ''))
     print()
 
     if not os.path.exists(argv[3]):
         print('Input does not exist: {}'.format(argv[3]), file=sys.stderr)
         return
 
-    if os.path.exists(argv[4]) and not os.path.isdir(argv[4]):
-        print('Output is not a directory: {}'.format(argv[4]), file=sys.stderr)
-        return
+    for output_path, _, _ in targets:
+        is_archive = isinstance(open_output(output_path), ZipOutput)
+        if os.path.exists(output_path) and not is_archive and not os.path.isdir(output_path):
+            print('Output is not a directory: {}'.format(output_path), file=sys.stderr)
+            return
 
-    generator = None
-
-    if os.path.isdir(argv[3]):
-        generator = directory_generator(argv[3])
-    else:
-        _, ext = os.path.splitext(argv[3])
-        if ext == '.zip' or ext == '.cbz':
-            generator = zip_generator(argv[3])
-        if ext == '.azw3':
-            generator = azw3_generator(argv[3])
+    generator = open_generator(argv[3], natural)
 
     if generator is None:
         print('Unsupported input file type: {}'.format(argv[3]), file=sys.stderr)
         print('Supported file types: directory, zip, cbz, azw3', file=sys.stderr)
         return
 
-    process_with_generator(generator, argv[4], width, height)
+    if not process_with_generator(generator, targets, direction, stages, threads, dedup):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,8 @@
 import tempfile
 import os
+import shutil
+import hashlib
+import json
 from lxml import etree
 
 from kindleunpack.kindleunpack import unpackBook
@@ -117,17 +120,169 @@ def make_flat_toc(images_list, toc):
     return flat_toc
 
 
-def read_azw3(filepath):
+# Options passed to kindleunpack. These are part of the cache key, since
+# a different option set can produce different images.
+UNPACK_OPTIONS = {'epubver': '2', 'use_hd': False}
+
+# Unpack cache. Opt-in: set KF8COMIC_CACHE_DIR (or pass cache_dir) to keep
+# the extracted images so the same book is only unpacked once.
+CACHE_VERSION = 1
+CACHE_DIR_ENV = 'KF8COMIC_CACHE_DIR'
+CACHE_MAX_SIZE_ENV = 'KF8COMIC_CACHE_MAX_SIZE'
+DEFAULT_CACHE_MAX_SIZE = 2 * 1024 ** 3
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_digest(filepath):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_key(filepath):
+    options = json.dumps(UNPACK_OPTIONS, sort_keys=True)
+    h = hashlib.sha256()
+    h.update('v{}\n'.format(CACHE_VERSION).encode('utf-8'))
+    h.update(file_digest(filepath).encode('utf-8'))
+    h.update(options.encode('utf-8'))
+    return h.hexdigest()
+
+
+# Return (flat_toc, images, rtl) from a cache entry, or None if the entry
+# is missing or does not match its manifest.
+def cache_load(entry):
+    try:
+        with open(os.path.join(entry, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest['version'] != CACHE_VERSION:
+            return None
+        images = []
+        for name, size in manifest['images']:
+            path = os.path.join(entry, name)
+            if os.path.getsize(path) != size:
+                return None
+            images.append(path)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    # Mark as recently used for eviction
+    os.utime(os.path.join(entry, MANIFEST_NAME))
+    return [list(x) for x in manifest['flat_toc']], images, manifest['rtl']
+
+
+def cache_size(entry):
+    total = 0
+    for root, dirs, files in os.walk(entry):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+# Remove least recently used entries until the cache (plus `incoming` bytes)
+# fits within `max_size`.
+def cache_evict(cache_dir, max_size, incoming=0):
+    entries = []
+    for x in os.scandir(cache_dir):
+        if not x.is_dir() or x.name.startswith('.'):
+            continue
+        try:
+            used = os.path.getmtime(os.path.join(x.path, MANIFEST_NAME))
+        except OSError:
+            used = 0
+        entries.append((used, x.path, cache_size(x.path)))
+
+    entries.sort()
+    total = sum(x[2] for x in entries) + incoming
+    for _, path, size in entries:
+        if total <= max_size:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def cache_store(entry, flat_toc, images, rtl, max_size):
+    cache_dir = os.path.dirname(entry)
+    incoming = sum(os.path.getsize(x) for x in set(images))
+    cache_evict(cache_dir, max_size, incoming)
+
+    # Build in a private directory, then move into place
+    staging = tempfile.mkdtemp(prefix='.', dir=cache_dir)
+    try:
+        names = {}
+        manifest_images = []
+        for src in images:
+            if src not in names:
+                name = '{:05d}{}'.format(len(names), os.path.splitext(src)[1].lower())
+                shutil.copyfile(src, os.path.join(staging, name))
+                names[src] = name
+            manifest_images.append((names[src], os.path.getsize(src)))
+
+        manifest = {
+            'version': CACHE_VERSION,
+            'images': manifest_images,
+            'flat_toc': flat_toc,
+            'rtl': rtl,
+        }
+        with open(os.path.join(staging, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        os.replace(staging, entry)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+
+def unpack_azw3(filepath):
     tmpdir = tempfile.TemporaryDirectory()
-    unpackBook(filepath, tmpdir.name)
+    unpackBook(filepath, tmpdir.name, **UNPACK_OPTIONS)
     title, images_list, toc, rtl = read_metadata(tmpdir.name)
     flat_toc = make_flat_toc(images_list, toc)
 
     return flat_toc, [x[1] for x in images_list], tmpdir, rtl
 
 
+# Read AZW3 file
+# Return: flat TOC, list of image paths, temporary directory holding the
+# images (None when served from cache), RTL flag
+def read_azw3(filepath, cache_dir=None, cache_max_size=None):
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        return unpack_azw3(filepath)
+
+    if cache_max_size is None:
+        cache_max_size = int(os.environ.get(CACHE_MAX_SIZE_ENV, DEFAULT_CACHE_MAX_SIZE))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, cache_key(filepath))
+
+    cached = cache_load(entry)
+    if cached is not None:
+        flat_toc, images, rtl = cached
+        return flat_toc, images, None, rtl
+
+    flat_toc, images, tmpdir, rtl = unpack_azw3(filepath)
+    try:
+        cache_store(entry, flat_toc, images, rtl, cache_max_size)
+    except OSError as e:
+        print('Warning: cannot write unpack cache: {}'.format(e))
+        return flat_toc, images, tmpdir, rtl
+
+    cached = cache_load(entry)
+    if cached is None:
+        return flat_toc, images, tmpdir, rtl
+
+    tmpdir.cleanup()
+    flat_toc, images, rtl = cached
+    return flat_toc, images, None, rtl
+
+
 if __name__ == '__main__':
     import sys
-    flat_toc, images, _ = read_azw3(sys.argv[1])
+    flat_toc, images, _, _ = read_azw3(sys.argv[1])
     print(flat_toc)
     print(images)
@@ -1,19 +1,57 @@
 import math
+import io
 
-import pikepdf
 from fpdf import FPDF, ViewerPreferences
+from fpdf.enums import PageLayout
+from fpdf.syntax import Name
 from PIL import Image
 import os
 
 from kf8comic import read_azw3
+from kindleunpack.imageprobe import probe_file
 
 DEFAULT_DPI = 300
 DEFAULT_DPM = DEFAULT_DPI / 25.4
 
+# Embed JPEG pages as-is (DCTDecode) instead of decoding them with Pillow
+JPEG_PASSTHROUGH = True
+
+
+# fpdf2 writes /Direction from its TextDirection enum (LTR/RTL), but PDF
+# expects the names /L2R or /R2L, so store the name directly.
+class BookViewerPreferences(ViewerPreferences):
+    @property
+    def direction(self):
+        return self._direction
+
+    @direction.setter
+    def direction(self, direction):
+        self._direction = None if direction is None else Name(direction)
+
+
+# Return the image to pass to FPDF.image, with its size in pixels
+def load_page(image):
+    info = probe_file(image)
+    if info is None:
+        # Unknown to the probe, let Pillow handle it
+        img = Image.open(image)
+        return img, img.size
+
+    kind, width, height, mode = info
+    if JPEG_PASSTHROUGH and kind == 'jpeg':
+        with open(image, 'rb') as f:
+            return io.BytesIO(f.read()), (width, height)
+
+    # Open with Pillow, decoding is left to fpdf2
+    return Image.open(image), (width, height)
+
 
 def main(argv):
+    linearize = '--linearize' in argv
+    argv = [x for x in argv if x != '--linearize']
+
     if len(argv) < 2:
-        print('Usage: python kf8pdf.py <inputfile> [<outputfile>]')
+        print('Usage: python kf8pdf.py [--linearize] <inputfile> [<outputfile>]')
         return
 
     input_file = argv[1]
@@ -31,9 +69,11 @@ def main(argv):
 
     # Create PDF
     pdf = FPDF()
-    pdf.set_display_mode('fullpage', 'two')
+    # Two-page reading, with RTL direction set directly in the catalog
+    pdf.set_display_mode('fullpage', PageLayout.TWO_PAGE_RIGHT)
     pdf.set_margin(0)
-    pdf.viewer_preferences = ViewerPreferences(hide_toolbar=True, hide_menubar=False, fit_window=True)
+    pdf.viewer_preferences = BookViewerPreferences(hide_toolbar=True, hide_menubar=False, fit_window=True,
+                                                   direction='R2L' if rtl else None)
 
     print('Creating PDF...')
 
@@ -43,9 +83,7 @@ def main(argv):
             skipped_next_image = False
             continue
 
-        # Open with Pillow
-        img = Image.open(image)
-        width, height = img.size
+        img, (width, height) = load_page(image)
 
         # Convert directly to mm
         width /= DEFAULT_DPM
@@ -58,14 +96,14 @@ def main(argv):
         if (i + 1) in toc_map:
             pdf.start_section(toc_map[i + 1])
 
-    pdf.output(output)
-
-    # Set RTL and two-column reading
-    with pikepdf.Pdf.open(output, allow_overwriting_input=True) as pdf:
-        pdf.Root.PageLayout = pikepdf.Name.TwoPageRight
-        if rtl:
-            pdf.Root.ViewerPreferences.Direction = pikepdf.Name.R2L
-        pdf.save()
+    if linearize:
+        # fpdf2 cannot linearize documents with images yet, so let qpdf
+        # reorder the objects of the in-memory PDF while writing it out.
+        import pikepdf
+        with pikepdf.Pdf.open(io.BytesIO(pdf.output())) as linearized:
+            linearized.save(output, linearize=True)
+    else:
+        pdf.output(output)
 
     print('PDF saved to {}'.format(output))
 
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+from .unipath import pathof
+
+import struct
+# note:  struct pack, unpack, unpack_from all require bytestring format
+# data all the way up to at least python 2.7.5, python 3 okay with bytestring
+
+# Header-only image probing. Only the first bytes of an image are parsed,
+# no pixel data is ever decoded.
+
+PROBE_SIZE = 64 * 1024
+""" Bytes read from a file before probing. JPEG files with large
+metadata segments are read further as needed. """
+
+MAX_PROBE_SIZE = 16 * 1024 * 1024
+""" Give up looking for the JPEG SOF marker after this many bytes. """
+
+NEED_MORE = object()
+
+JPEG_MODES = {1: 'L', 3: 'RGB', 4: 'CMYK'}
+PNG_MODES = {0: 'L', 2: 'RGB', 3: 'P', 4: 'LA', 6: 'RGBA'}
+
+
+def sniff_type(head):
+    '''Return the image type of data starting with head, using the same
+    names as the old imghdr module, or None.'''
+    head = bytes(head[:12])
+    if head[:3] == b'\xFF\xD8\xFF':
+        return 'jpeg'
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:2] == b'BM':
+        return 'bmp'
+    if head[:2] in (b'MM', b'II'):
+        return 'tiff'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def _probe_jpeg(data):
+    pos = 2
+    while True:
+        if pos + 4 > len(data):
+            return NEED_MORE
+        prefix, marker = struct.unpack_from(b'>BB', data, pos)
+        if prefix != 0xFF:
+            return None
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # standalone marker, no length
+            pos += 2
+            continue
+        if marker < 0xC0 or marker == 0xD9 or marker == 0xDA:
+            # reserved marker, end of image or start of scan before any SOF
+            return None
+        length = struct.unpack_from(b'>H', data, pos + 2)[0]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if pos + 10 > len(data):
+                return NEED_MORE
+            height, width, components = struct.unpack_from(b'>HHB', data, pos + 5)
+            return 'jpeg', width, height, JPEG_MODES.get(components)
+        pos += 2 + length
+
+
+def _probe_png(data):
+    if len(data) < 26 or bytes(data[12:16]) != b'IHDR':
+        return None
+    width, height, depth, color = struct.unpack_from(b'>IIBB', data, 16)
+    mode = PNG_MODES.get(color)
+    if color == 0 and depth == 1:
+        mode = '1'
+    elif color == 0 and depth == 16:
+        mode = 'I;16'
+    return 'png', width, height, mode
+
+
+def _probe_gif(data):
+    if len(data) < 10:
+        return None
+    width, height = struct.unpack_from(b'<HH', data, 6)
+    return 'gif', width, height, 'P'
+
+
+def _probe_bmp(data):
+    if len(data) < 26:
+        return None
+    header_size = struct.unpack_from(b'<I', data, 14)[0]
+    if header_size == 12:
+        # OS/2 BITMAPCOREHEADER
+        width, height, _, bits = struct.unpack_from(b'<HHHH', data, 18)
+    else:
+        if len(data) < 30:
+            return None
+        width, height, _, bits = struct.unpack_from(b'<iiHH', data, 18)
+    mode = 'P' if bits <= 8 else 'RGB'
+    if bits == 32:
+        mode = 'RGBA'
+    return 'bmp', abs(width), abs(height), mode
+
+
+def probe_buffer(data):
+    '''Probe image data (or a prefix of it).
+
+    Return (type, width, height, mode), where mode follows Pillow naming,
+    None if the data is not a recognised image, or NEED_MORE if the
+    prefix ends before the dimensions.'''
+    imgtype = sniff_type(data)
+    try:
+        if imgtype == 'jpeg':
+            return _probe_jpeg(data)
+        if imgtype == 'png':
+            return _probe_png(data)
+        if imgtype == 'gif':
+            return _probe_gif(data)
+        if imgtype == 'bmp':
+            return _probe_bmp(data)
+    except struct.error:
+        return None
+    return None
+
+
+def probe_stream(f, size=PROBE_SIZE, max_size=MAX_PROBE_SIZE):
+    '''Probe an open binary file, reading only as much as needed.
+
+    size bytes are read first, then twice as much each time the header
+    is not complete, up to max_size.'''
+    data = f.read(size)
+    while True:
+        info = probe_buffer(data)
+        if info is not NEED_MORE:
+            return info
+        if len(data) >= max_size:
+            return None
+        more = f.read(len(data))
+        if not more:
+            return None
+        data += more
+
+
+def probe_file(filename):
+    '''Probe an image file, reading only as much as needed.'''
+    with open(pathof(filename), 'rb') as f:
+        return probe_stream(f)
+
+
+def probe_image(source):
+    '''Probe an image given as bytes, a file object or a file name.
+
+    Return (type, width, height, mode) or None.'''
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        info = probe_buffer(source)
+        return None if info is NEED_MORE else info
+    if hasattr(source, 'read'):
+        pos = source.tell()
+        try:
+            return probe_stream(source)
+        finally:
+            source.seek(pos)
+    return probe_file(source)
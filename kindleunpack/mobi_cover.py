@@ -7,12 +7,8 @@ from __future__ import unicode_literals, division, absolute_import, print_functi
 from .compatibility_utils import unicode_str
 
 from .unipath import pathof
+from .imageprobe import PROBE_SIZE, sniff_type, probe_buffer, probe_file, probe_image
 import os
-import imghdr
-
-import struct
-# note:  struct pack, unpack, unpack_from all require bytestring format
-# data all the way up to at least python 2.7.5, python 3 okay with bytestring
 
 USE_SVG_WRAPPER = True
 """ Set to True to use svg wrapper for default. """
@@ -34,88 +30,27 @@ MAX_HEIGHT = 4096
 
 
 def get_image_type(imgname, imgdata=None):
-    imgtype = unicode_str(imghdr.what(pathof(imgname), imgdata))
-
-    # imghdr only checks for JFIF or Exif JPEG files. Apparently, there are some
-    # with only the magic JPEG bytes out there...
-    # ImageMagick handles those, so, do it too.
-    if imgtype is None:
-        if imgdata is None:
-            with open(pathof(imgname), 'rb') as f:
-                imgdata = f.read()
-        if imgdata[0:2] == b'\xFF\xD8':
-            # Get last non-null bytes
-            last = len(imgdata)
-            while (imgdata[last-1:last] == b'\x00'):
-                last-=1
-            # Be extra safe, check the trailing bytes, too.
-            if imgdata[last-2:last] == b'\xFF\xD9':
-                imgtype = "jpeg"
-    return imgtype
+    if imgdata is None:
+        with open(pathof(imgname), 'rb') as f:
+            imgdata = f.read(PROBE_SIZE)
+    imgtype = sniff_type(imgdata)
 
+    # Only the magic bytes are checked above, which is not much for JPEG.
+    # Be extra safe and make sure the JPEG markers lead to a frame header.
+    if imgtype == 'jpeg' and probe_buffer(imgdata) is None:
+        imgtype = None
+    return unicode_str(imgtype) if imgtype is not None else None
 
-def get_image_size(imgname, imgdata=None):
-    '''Determine the image type of imgname (or imgdata) and return its size.
 
-    Originally,
-    Determine the image type of fhandle and return its size.
-    from draco'''
+def get_image_size(imgname, imgdata=None):
+    '''Determine the image type of imgname (or imgdata) and return its size.'''
     if imgdata is None:
-        fhandle = open(pathof(imgname), 'rb')
-        head = fhandle.read(24)
-    else:
-        head = imgdata[0:24]
-    if len(head) != 24:
-        return
-
-    imgtype = get_image_type(imgname, imgdata)
-    if imgtype == 'png':
-        check = struct.unpack(b'>i', head[4:8])[0]
-        if check != 0x0d0a1a0a:
-            return
-        width, height = struct.unpack(b'>ii', head[16:24])
-    elif imgtype == 'gif':
-        width, height = struct.unpack(b'<HH', head[6:10])
-    elif imgtype == 'jpeg' and imgdata is None:
-        try:
-            fhandle.seek(0)  # Read 0xff next
-            size = 2
-            ftype = 0
-            while not 0xc0 <= ftype <= 0xcf:
-                fhandle.seek(size, 1)
-                byte = fhandle.read(1)
-                while ord(byte) == 0xff:
-                    byte = fhandle.read(1)
-                ftype = ord(byte)
-                size = struct.unpack(b'>H', fhandle.read(2))[0] - 2
-            # We are at a SOFn block
-            fhandle.seek(1, 1)  # Skip `precision' byte.
-            height, width = struct.unpack(b'>HH', fhandle.read(4))
-        except Exception:  # IGNORE:W0703
-            return
-    elif imgtype == 'jpeg' and imgdata is not None:
-        try:
-            pos = 0
-            size = 2
-            ftype = 0
-            while not 0xc0 <= ftype <= 0xcf:
-                pos += size
-                byte = imgdata[pos:pos+1]
-                pos += 1
-                while ord(byte) == 0xff:
-                    byte = imgdata[pos:pos+1]
-                    pos += 1
-                ftype = ord(byte)
-                size = struct.unpack(b'>H', imgdata[pos:pos+2])[0] - 2
-                pos += 2
-            # We are at a SOFn block
-            pos += 1  # Skip `precision' byte.
-            height, width = struct.unpack(b'>HH', imgdata[pos:pos+4])
-            pos += 4
-        except Exception:  # IGNORE:W0703
-            return
+        info = probe_file(imgname)
     else:
+        info = probe_image(imgdata)
+    if info is None:
         return
+    imgtype, width, height, mode = info
     return width, height
 
 # XXX experimental
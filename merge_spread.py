@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
 from PIL import Image
+import numpy as np
 import glob
 import os
 import math
 import shutil
+import subprocess
+import tempfile
 
 
 # Convert color to linear light according to sRGB
@@ -16,9 +19,70 @@ def c_lin(c):
         return ((c + 0.055) / 1.055) ** 2.4
 
 
+# Linear light of every 8-bit sRGB value
+SRGB_LUT = np.array([c_lin(x) for x in range(256)], dtype=np.float64)
+
+
 # Calculate Root Mean Squared (RMS) of the list
 def rms(l):
-    return math.sqrt(sum([x**2 for x in l]) / len(l))
+    # Sum in Python to keep the same rounding as summing the list one by one
+    return math.sqrt(sum(np.square(np.asarray(l, dtype=np.float64)).tolist()) / len(l))
+
+
+# Relative luminance of column x of the image, in linear light
+def column_luminance(image, x):
+    column = image.crop((x, 0, x + 1, image.height))
+    if column.mode != 'RGB':
+        column = column.convert('RGB')
+    rgb = SRGB_LUT[np.asarray(column, dtype=np.uint8).reshape(-1, 3)]
+    return 0.2126*rgb[:, 0] + 0.7152*rgb[:, 1] + 0.0722*rgb[:, 2]
+
+
+# JPEG draft mode scale used by read_edges(draft=True)
+DRAFT_SCALE = 4
+
+
+# Luminance of the left and right edge columns of an image.
+# This is the only part of the page the spread heuristic needs, so each
+# page is decoded once and only its edges are kept.
+# Return: original (width, height), left column, right column
+def image_edges(img, draft=False):
+    size = img.size
+    if draft and img.format == 'JPEG':
+        # Let the JPEG decoder downscale, edges become approximate
+        img.draft(img.mode, (1, max(1, img.height // DRAFT_SCALE)))
+    return size, column_luminance(img, 0), column_luminance(img, img.width - 1)
+
+
+# Read edges of an image file, see image_edges
+def read_edges(path, draft=False):
+    with Image.open(path) as img:
+        return image_edges(img, draft)
+
+
+# Calculate contrast between two seam columns (luminance in linear light)
+# Return: percentage of that is used to calculate, contrast
+def calculate_seam_contrast(y0, y1):
+    if len(y0) != len(y1):
+        return 0, 0
+
+    diff = np.abs(y0 - y1)
+
+    # Ignore white background
+    ca = diff[(y0 < 0.95) & (y1 < 0.95)]
+
+    # Ignore black background
+    cb = diff[(0.05 < y0) & (0.05 < y1)]
+
+    # If all the pixels are white or black, return 0
+    if len(ca) == 0 or len(cb) == 0:
+        return 0, 0
+
+    # Return whichever has less percentage of content compared to background
+    if len(ca) < len(cb):
+        return len(ca) / len(y0), rms(ca)
+    else:
+        return len(cb) / len(y0), rms(cb)
 
 
 # Calculate contrast of the spread between two images
@@ -36,38 +100,22 @@ def calculate_spread_contrast(direction, f0, f1):
         x0 = 0
         x1 = f1.width - 1
 
-    if f0.mode != 'RGB':
-        f0 = f0.convert('RGB')
-
-    if f1.mode != 'RGB':
-        f1 = f1.convert('RGB')
-
-    ca, cb = [], []
-    for y in range(f0.height):
-        [r0, g0, b0] = [c_lin(x) for x in f0.getpixel((x0, y))]
-        [r1, g1, b1] = [c_lin(x) for x in f1.getpixel((x1, y))]
+    return calculate_seam_contrast(column_luminance(f0, x0), column_luminance(f1, x1))
 
-        # Calculate luminance
-        y0 = 0.2126*r0 + 0.7152*g0 + 0.0722*b0
-        y1 = 0.2126*r1 + 0.7152*g1 + 0.0722*b1
 
-        # Ignore white background
-        if y0 < 0.95 and y1 < 0.95:
-            ca.append(abs(y0 - y1))
-
-        # Ignore black background
-        if 0.05 < y0 and 0.05 < y1:
-            cb.append(abs(y0 - y1))
-
-    # If all the pixels are white or black, return 0
-    if len(ca) == 0 or len(cb) == 0:
+# Calculate contrast of the spread from the edges returned by read_edges
+def calculate_edges_contrast(direction, e0, e1):
+    (_, h0), left0, right0 = e0
+    (_, h1), left1, right1 = e1
+    if h0 != h1:
         return 0, 0
 
-    # Return whichever has less percentage of content compared to background
-    if len(ca) < len(cb):
-        return len(ca) / f0.height, rms(ca)
-    else:
-        return len(cb) / f0.height, rms(cb)
+    y0, y1 = (left0, right1) if direction == -1 else (right0, left1)
+    if len(y0) != len(y1):
+        # Only one of the pages was read in draft mode
+        n = min(len(y0), len(y1))
+        y0, y1 = [np.interp(np.linspace(0, len(y) - 1, n), np.arange(len(y)), y) for y in (y0, y1)]
+    return calculate_seam_contrast(y0, y1)
 
 
 # Merge to image together
@@ -84,9 +132,102 @@ def merge_image(f0, f1, direction):
     return img
 
 
+# jpegtran (libjpeg 9 or libjpeg-turbo 2.1+) for lossless JPEG merging
+JPEGTRAN = shutil.which('jpegtran')
+
+# JPEG quality used when a JPEG spread cannot be merged losslessly
+FALLBACK_JPEG_QUALITY = 95
+
+
+# Return the MCU width of a JPEG if both images can be joined at the DCT
+# coefficient level (same height, components, sampling and quantization
+# tables), otherwise None.
+def jpeg_merge_mcu_width(left, right):
+    if left.format != 'JPEG' or right.format != 'JPEG':
+        return None
+    if left.height != right.height or left.mode != right.mode:
+        return None
+    # Component layers are (id, h sampling, v sampling, quantization table)
+    if left.layer != right.layer or left.quantization != right.quantization:
+        return None
+    return 8 * max(x[1] for x in left.layer)
+
+
+# Join two JPEG files side by side without decoding them, using jpegtran to
+# expand the left page and drop the right page into the new area.
+# Return: True if the spread was written
+def merge_jpeg_lossless(left_path, right_path, output):
+    if JPEGTRAN is None:
+        return False
+
+    with Image.open(left_path) as left, Image.open(right_path) as right:
+        mcu_width = jpeg_merge_mcu_width(left, right)
+        if mcu_width is None or left.width % mcu_width != 0:
+            return False
+        size = (left.width + right.width, left.height)
+        left_width = left.width
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        expanded = os.path.join(tmpdir, 'expanded.jpg')
+        try:
+            subprocess.run([JPEGTRAN, '-copy', 'all', '-crop', '{}x{}+0+0'.format(*size),
+                            '-outfile', expanded, left_path],
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            subprocess.run([JPEGTRAN, '-copy', 'all', '-drop', '+{}+0'.format(left_width), right_path,
+                            '-outfile', output, expanded],
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            with Image.open(output) as img:
+                if img.size == size:
+                    return True
+        except (OSError, subprocess.CalledProcessError):
+            pass
+
+    # jpegtran without -drop or expanding -crop support
+    if os.path.exists(output):
+        os.remove(output)
+    return False
+
+
+# Put the file in the output directory without copying data if possible
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+# Write a merged spread of f0 and f1, or copy f0 when f1 is None
+def write_output(f0, f1, direction, output, link=False):
+    if f1 is None:
+        if link:
+            link_or_copy(f0, output)
+        else:
+            shutil.copy2(f0, output)
+        return
+
+    left, right = (f0, f1) if direction == 1 else (f1, f0)
+    if merge_jpeg_lossless(left, right, output):
+        return
+
+    with Image.open(f0) as img0, Image.open(f1) as img1:
+        img = merge_image(img0, img1, direction)
+    if os.path.splitext(output)[1].lower() in ('.jpg', '.jpeg'):
+        img.save(output, quality=FALLBACK_JPEG_QUALITY)
+    else:
+        img.save(output)
+
+
+def usage():
+    print('Usage: python merge_spread.py [--draft] [--link] <ltr|rtl> <inputdirectory> <outputfile>')
+
+
 def main(argv):
+    draft = '--draft' in argv
+    link = '--link' in argv
+    argv = [x for x in argv if x not in ('--draft', '--link')]
+
     if len(argv) < 4:
-        print('Usage: python merge_spread.py <ltr|rtl> <inputdirectory> <outputfile>')
+        usage()
         return
 
     if argv[1] == 'ltr':
@@ -94,7 +235,7 @@ def main(argv):
     elif argv[1] == 'rtl':
         direction = -1
     else:
-        print('Usage: python merge_spread.py <ltr|rtl> <inputdirectory> <outputfile>')
+        usage()
         return
 
     input_dir = glob.escape(argv[2])
@@ -112,38 +253,39 @@ def main(argv):
         print('Output path is not a directory')
         return
 
-    f0 = Image.open(files[0])
-    skipped_next_file = False
+    from multiprocessing import Pool
 
-    # Try all pairs of page
-    for i in range(1, len(files)):
-        f1 = Image.open(files[i])
+    with Pool() as pool:
+        # Read edges of all pages, then score every adjacent pair
+        edges = pool.starmap(read_edges, [(x, draft) for x in files], chunksize=4)
+        scores = [calculate_edges_contrast(direction, edges[i-1], edges[i]) for i in range(1, len(files))]
 
-        if skipped_next_file:
-            # Current page f0 has already been use in a double-page spread, skipping
-            skipped_next_file = False
-        else:
-            # Check contrast
-            pct, contrast = calculate_spread_contrast(direction, f0, f1)
+        # Pair pages, a page can only be in one double-page spread
+        actions = []
+        skipped_next_file = False
+        for i in range(1, len(files)):
+            if skipped_next_file:
+                # Current page f0 has already been use in a double-page spread, skipping
+                skipped_next_file = False
+                continue
+
+            pct, contrast = scores[i-1]
 
             # This is arbitrary threshold, but it seems to work well
             if pct > 0.15 and contrast < 0.25:
                 print('{} {} {:2.0f}%  {:.2f}'.format(files[i-1], files[i], pct*100, contrast))
-                img = merge_image(f0, f1, direction)
                 img_name = os.path.splitext(os.path.basename(files[i-1]))[0] + '-' + os.path.splitext(os.path.basename(files[i]))[0] + os.path.splitext(os.path.basename(files[i-1]))[1]
-                img.save(os.path.join(output_path, img_name))
+                actions.append((files[i-1], files[i], direction, os.path.join(output_path, img_name), link))
                 skipped_next_file = True
             else:
                 # Otherwise, just copy the file
-                shutil.copy2(files[i-1], os.path.join(output_path, os.path.basename(files[i-1])))
-
-        f0.close()
-        f0 = f1
+                actions.append((files[i-1], None, direction, os.path.join(output_path, os.path.basename(files[i-1])), link))
 
-    f0.close()
+        if not skipped_next_file:
+            actions.append((files[-1], None, direction, os.path.join(output_path, os.path.basename(files[-1])), link))
 
-    if not skipped_next_file:
-        shutil.copy2(files[-1], os.path.join(output_path, os.path.basename(files[-1])))
+        # Write merged images and copy the rest
+        pool.starmap(write_output, actions, chunksize=4)
 
 
 if __name__ == '__main__':